@@ -0,0 +1,398 @@
+import argparse
+import asyncio
+import gc
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import psutil
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, "benchmark_baseline.json")
+MODULE_COUNTS = [10, 100, 500]
+ITERATIONS = 200
+SLOW_ITERATIONS = 20
+DM_BATCH = 5
+REGRESSION_THRESHOLD = 0.25
+REGRESSION_MIN_MS = 0.5
+PREFIX = "."
+
+SYNTHETIC_MODULE = '''# version: 1.0
+from pyrogram import filters
+
+cinfo = "Synthetic module {index}"
+
+
+def register_module(app):
+    @app.on_message(filters.me & filters.command("{name}", prefixes="{prefix}"))
+    async def _{name}_command(_, message):
+        await message.edit("{name} " + " ".join(message.command[1:]))
+
+    @app.on_message(filters.me & filters.command("{name}_info", prefixes="{prefix}"))
+    async def _{name}_info_command(_, message):
+        import os
+        await message.edit(str(os.getpid()))
+'''
+
+
+def synthetic_module(name, index):
+    return SYNTHETIC_MODULE.format(name=name, index=index, prefix=PREFIX)
+
+
+class FakeMessage:
+    ids = iter(range(1, 10 ** 9))
+
+    def __init__(self, client, text="", chat_id=1, reply_to_message=None, document=None):
+        self._client = client
+        self.id = next(self.ids)
+        self.chat = SimpleNamespace(id=chat_id, type=None, title=None, username=None)
+        self.from_user = SimpleNamespace(id=client.me.id, is_self=True, is_bot=False, first_name="Yuki", username=client.me.username)
+        self.outgoing = True
+        self.text = text
+        self.caption = None
+        self.command = None
+        self.media = None
+        self.reply_to_message = reply_to_message
+        self.document = document
+        self.edits = []
+        self.finished = asyncio.Event()
+
+    async def edit(self, text, **kwargs):
+        self.text = text
+        self.edits.append(text)
+        self._client.sent += 1
+        if "✅" in text or "❌" in text:
+            self.finished.set()
+        return self
+
+    edit_text = edit
+
+    async def reply_text(self, text, **kwargs):
+        self._client.sent += 1
+        self.finished.set()
+        return FakeMessage(self._client, text, self.chat.id)
+
+    async def delete(self, *args, **kwargs):
+        self._client.sent += 1
+        return True
+
+    async def download(self, file_name="", in_memory=False, **kwargs):
+        return await self._client.download_media(self, file_name, in_memory)
+
+
+def make_fake_client(client_class):
+    class FakeClient(client_class):
+        def __init__(self, name, api_id=None, api_hash=None, **kwargs):
+            super().__init__(name, api_id=api_id or 1, api_hash=api_hash or "0", in_memory=True, **kwargs)
+            self.me = SimpleNamespace(id=1, username="yuki_benchmark", first_name="Yuki", is_self=True)
+            self.sent = 0
+            self.documents = {}
+
+        async def send_message(self, chat_id, text, **kwargs):
+            self.sent += 1
+            return FakeMessage(self, text, chat_id)
+
+        async def edit_message_text(self, chat_id, message_id, text, **kwargs):
+            self.sent += 1
+            return FakeMessage(self, text, chat_id)
+
+        async def send_document(self, chat_id, document, caption="", **kwargs):
+            self.sent += 1
+            if isinstance(document, str) and os.path.exists(document):
+                self.documents["last"] = os.path.getsize(document)
+            return FakeMessage(self, caption, chat_id)
+
+        async def delete_messages(self, chat_id, message_ids, **kwargs):
+            self.sent += 1
+            return True
+
+        async def stream_media(self, message, limit=0, offset=0):
+            file_id = message if isinstance(message, str) else message.document.file_id
+            content = self.documents[file_id]
+            for position in range(0, len(content), 1024 * 1024):
+                yield content[position:position + 1024 * 1024]
+
+        async def download_media(self, message, file_name="", in_memory=False, **kwargs):
+            file_id = message if isinstance(message, str) else message.document.file_id
+            content = self.documents[file_id]
+            if in_memory:
+                return io.BytesIO(content)
+            with open(file_name, "wb") as file:
+                file.write(content)
+            return file_name
+
+    return FakeClient
+
+
+async def dispatch(app, message):
+    import pyrogram
+    for group in list(app.dispatcher.groups.values()):
+        for handler in group:
+            if not isinstance(handler, pyrogram.handlers.MessageHandler):
+                continue
+            try:
+                if await handler.check(app, message):
+                    result = handler.callback(app, message)
+                    if asyncio.iscoroutine(result):
+                        await result
+                    break
+            except pyrogram.StopPropagation:
+                return
+            except pyrogram.ContinuePropagation:
+                continue
+
+
+async def settle(app):
+    count = -1
+    while count != sum(len(group) for group in app.dispatcher.groups.values()):
+        count = sum(len(group) for group in app.dispatcher.groups.values())
+        await asyncio.sleep(0.01)
+
+
+async def start_http_stand_in():
+    from aiohttp import web
+
+    async def module_source(request):
+        name = request.match_info["name"]
+        return web.Response(text=synthetic_module(name, 0), content_type="text/x-python")
+
+    server = web.Application()
+    server.router.add_get("/modules/{name}.py", module_source)
+    runner = web.AppRunner(server, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+
+
+def summarize(latencies, total):
+    latencies = sorted(latencies)
+    return {
+        "iterations": len(latencies),
+        "throughput": round(len(latencies) / total, 2) if total else 0,
+        "mean_ms": round(statistics.mean(latencies) * 1000, 3),
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3),
+        "p95_ms": round(latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)] * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3),
+    }
+
+
+async def measure(app, make_message, iterations, wait=False, timeout=30):
+    latencies = []
+    started = time.perf_counter()
+    for index in range(iterations):
+        message = make_message(index)
+        command_start = time.perf_counter()
+        await dispatch(app, message)
+        if wait:
+            await asyncio.wait_for(message.finished.wait(), timeout)
+        latencies.append(time.perf_counter() - command_start)
+    return summarize(latencies, time.perf_counter() - started)
+
+
+async def run_benchmark(module_count, iterations):
+    import_start = time.perf_counter()
+    import yuki
+    imports = time.perf_counter() - import_start
+
+    yuki.Client = make_fake_client(yuki.Client)
+    yuki.SH_EDIT_INTERVAL = 3600
+    for handler in logging.getLogger().handlers:
+        handler.setLevel(logging.WARNING)
+    yuki.setup_logging()
+    for handler in yuki.logging_state["listener"].handlers:
+        if type(handler) is logging.StreamHandler:
+            handler.setLevel(logging.WARNING)
+    runner, base_url = await start_http_stand_in()
+    yuki.MODULES_REPO_URL = base_url + "/modules/{name}.py"
+
+    names = [f"bench{index}" for index in range(module_count)]
+    for index, name in enumerate(names):
+        with open(f"{name}.py", "w") as file:
+            file.write(synthetic_module(name, index))
+    with open(yuki.config_file, "w") as file:
+        json.dump({"api_id": 1, "api_hash": "0", "prefix": PREFIX}, file)
+    with open(yuki.modules_file, "w") as file:
+        json.dump(names, file)
+
+    gc.collect()
+    rss_before = psutil.Process().memory_info().rss
+    startup_start = time.perf_counter()
+    app, yuki_prefix = await yuki.init_bot()
+    init = time.perf_counter() - startup_start
+    await yuki.load_and_exec_modules(app, yuki_prefix)
+    modules = time.perf_counter() - startup_start - init
+    await yuki.register_core_commands(app, yuki_prefix)
+    startup = time.perf_counter() - startup_start
+    await settle(app)
+    gc.collect()
+    rss_after = psutil.Process().memory_info().rss
+
+    results = {
+        "modules": module_count,
+        "handlers": sum(len(group) for group in app.dispatcher.groups.values()),
+        "startup": {
+            "imports_ms": round(imports * 1000, 3),
+            "init_bot_ms": round(init * 1000, 3),
+            "load_and_exec_modules_ms": round(modules * 1000, 3),
+            "total_ms": round(startup * 1000, 3),
+        },
+        "memory": {
+            "startup_rss_delta_kb": round((rss_after - rss_before) / 1024, 1),
+            "rss_per_module_kb": round((rss_after - rss_before) / 1024 / module_count, 2),
+        },
+        "commands": {},
+    }
+    commands = results["commands"]
+
+    commands["help"] = await measure(app, lambda _: FakeMessage(app, f"{PREFIX}help"), iterations)
+    commands["ping"] = await measure(app, lambda _: FakeMessage(app, f"{PREFIX}ping"), iterations)
+    commands["module"] = await measure(app, lambda index: FakeMessage(app, f"{PREFIX}{names[-1]} {index}"), iterations)
+    commands["unknown"] = await measure(app, lambda index: FakeMessage(app, f"hello {index}"), iterations)
+
+    sources = [synthetic_module(names[index % module_count], index) for index in range(max(module_count, iterations))]
+    scan_start = time.perf_counter()
+    for source in sources:
+        yuki.check_code_for_risk_methods(source)
+    scan_total = time.perf_counter() - scan_start
+    commands["risk_scan"] = {
+        "files": len(sources),
+        "throughput": round(len(sources) / scan_total, 2),
+        "mb_per_s": round(sum(map(len, sources)) / scan_total / 1024 ** 2, 3),
+    }
+
+    def check_message(index):
+        app.documents[f"check{index}"] = synthetic_module(f"check{index}", index).encode() * 20
+        document = SimpleNamespace(file_id=f"check{index}", file_name=f"check{index}.py", mime_type="text/x-python", file_size=0)
+        return FakeMessage(app, f"{PREFIX}check", reply_to_message=SimpleNamespace(document=document))
+
+    commands["check"] = await measure(app, check_message, SLOW_ITERATIONS)
+
+    def lm_message(index):
+        app.documents[f"lm{index}"] = synthetic_module(f"lm{index}", index).encode()
+        document = SimpleNamespace(file_id=f"lm{index}", file_name=f"lm{index}.py", mime_type="text/x-python", file_size=0)
+        return FakeMessage(app, f"{PREFIX}lm", reply_to_message=SimpleNamespace(document=document))
+
+    commands["lm"] = await measure(app, lm_message, SLOW_ITERATIONS)
+    not_loaded = [f"lm{index}" for index in range(SLOW_ITERATIONS) if f"lm{index}" not in yuki.accounts[app]["registry"]]
+    if not_loaded:
+        raise RuntimeError(f".lm did not load {', '.join(not_loaded)}")
+
+    def dm_message(index):
+        batch = " ".join(f"remote{index}_{item}" for item in range(DM_BATCH))
+        return FakeMessage(app, f"{PREFIX}dm {batch}")
+
+    commands["dm"] = await measure(app, dm_message, SLOW_ITERATIONS)
+    commands["dm"]["modules_per_iteration"] = DM_BATCH
+    commands["backup"] = await measure(app, lambda index: FakeMessage(app, f"{PREFIX}backup full", chat_id=1000 + index), SLOW_ITERATIONS)
+    commands["backup"]["archive_kb"] = round(app.documents.get("last", 0) / 1024, 1)
+    commands["sh"] = await measure(app, lambda index: FakeMessage(app, f"{PREFIX}sh echo {index}"), SLOW_ITERATIONS, wait=True)
+
+    await runner.cleanup()
+    await yuki.shutdown_services()
+    results["memory"]["peak_rss_kb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 1)
+    return results
+
+
+def run_isolated(module_count, iterations):
+    work_dir = tempfile.mkdtemp(prefix="yuki_benchmark_")
+    try:
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run", str(module_count), "--iterations", str(iterations)],
+            cwd=work_dir, stdout=subprocess.PIPE, check=True,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join([BENCHMARK_DIR, work_dir])))
+        return json.loads(process.stdout.decode().strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def flatten(results, prefix=""):
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            values[f"{prefix}{key}"] = value
+    return values
+
+
+def compare(current, baseline, threshold):
+    regressions = []
+    for count, results in current["results"].items():
+        previous = flatten(baseline["results"].get(count, {}))
+        for key, value in flatten(results).items():
+            old = previous.get(key)
+            if not old or key.endswith(("iterations", "modules", "handlers", "files", "modules_per_iteration", "max_ms")):
+                continue
+            if key.endswith("_ms") and value - old < REGRESSION_MIN_MS:
+                continue
+            higher_is_better = key.endswith(("throughput", "mb_per_s"))
+            change = (old - value) / old if higher_is_better else (value - old) / old
+            if change > threshold:
+                regressions.append((count, key, old, value, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Yuki core commands against a fake client.")
+    parser.add_argument("--modules", type=int, nargs="+", default=MODULE_COUNTS)
+    parser.add_argument("--iterations", type=int, default=ITERATIONS)
+    parser.add_argument("--output", default=None, help="Write results to this file")
+    parser.add_argument("--save-baseline", action="store_true", help=f"Overwrite {os.path.basename(BASELINE_FILE)}")
+    parser.add_argument("--compare", nargs="?", const=BASELINE_FILE, default=None, help="Compare with a baseline file")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        results = asyncio.run(run_benchmark(args.run, args.iterations))
+        sys.stdout.write(json.dumps(results) + "\n")
+        return
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "results": {},
+    }
+    for module_count in args.modules:
+        print(f"Running benchmark with {module_count} modules...", file=sys.stderr)
+        report["results"][str(module_count)] = results = run_isolated(module_count, args.iterations)
+        commands = results["commands"]
+        print(f"  startup {results['startup']['total_ms']:.1f}ms, rss +{results['memory']['startup_rss_delta_kb']:.0f}KB, "
+              f"help p50 {commands['help']['p50_ms']:.3f}ms, module p50 {commands['module']['p50_ms']:.3f}ms, "
+              f"dm {commands['dm']['mean_ms']:.1f}ms", file=sys.stderr)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output)
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w") as file:
+            file.write(output)
+    if not args.output and not args.save_baseline:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(report, json.load(file), args.threshold)
+        for count, key, old, value, change in regressions:
+            print(f"REGRESSION [{count} modules] {key}: {old} -> {value} (+{change:.0%})", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline.", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
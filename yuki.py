@@ -1,69 +1,1516 @@
+import ast
+import concurrent.futures
+import contextlib
+import contextvars
+import copy
+import gzip
+import hashlib
 import importlib
+import importlib.metadata
+import inspect
 import re
 import sys
 import time
 from datetime import timedelta
 import aiohttp
 import aiofiles
-import requests
-from pyrogram import Client, filters
+import pyrogram
+from pyrogram import Client, ContinuePropagation, StopPropagation, enums, filters, idle
+from pyrogram.errors import FloodWait
 import os
 import json
 import logging
+import logging.handlers
 import asyncio
 import psutil
 import platform
+import resource
 import base64
-import subprocess
+import codecs
+import collections
+import functools
+import io
+import itertools
+import queue
+import shutil
+import signal
+import socket
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import traceback
+import types
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 start_time = time.time()
+startup_stats = {}
 config_file = "config.json"
 modules_file = "modules.json"
 
-
-async def read_json(file_name):
-    async with aiofiles.open(file_name, mode='r') as file:
-        content = await file.read()
-    return json.loads(content)
+LOG_DIR = "logs"
+LOG_FILE = "yuki.log"
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+LOG_BUFFER_SIZE = 2000
+LOG_FIELDS = {"account": "account", "source_module": "module", "command": "command", "chat": "chat",
+              "duration": "duration", "error": "error"}
+
+log_buffer = collections.deque(maxlen=LOG_BUFFER_SIZE)
+log_context = contextvars.ContextVar("log_context", default=None)
+logging_state = {"listener": None, "handlers": None}
+
+
+def add_log_context(record):
+    for key, value in (log_context.get() or {}).items():
+        if getattr(record, key, None) is None:
+            setattr(record, key, value)
+    return True
+
+
+def log_record_data(record):
+    data = {
+        "time": record.created,
+        "level": record.levelname,
+        "logger": record.name,
+        "message": record.getMessage(),
+    }
+    for attribute, key in LOG_FIELDS.items():
+        value = getattr(record, attribute, None)
+        if value is not None:
+            data[key] = value
+    if record.exc_text:
+        data["traceback"] = record.exc_text
+    return data
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        return json.dumps(log_record_data(record), ensure_ascii=False)
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.message = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class LogBufferHandler(logging.Handler):
+    def emit(self, record):
+        log_buffer.append(log_record_data(record))
+
+
+def compress_rotated_log(source, destination):
+    with open(source, 'rb') as log_file, gzip.open(destination, 'wb') as compressed_file:
+        shutil.copyfileobj(log_file, compressed_file)
+    os.remove(source)
+
+
+def setup_logging():
+    os.makedirs(LOG_DIR, exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(LOG_DIR, LOG_FILE), maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    file_handler.namer = lambda name: f"{name}.gz"
+    file_handler.rotator = compress_rotated_log
+    file_handler.setFormatter(JsonLogFormatter())
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    queue_handler = StructuredQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(add_log_context)
+    root = logging.getLogger()
+    logging_state["handlers"] = root.handlers[:]
+    root.handlers[:] = [queue_handler]
+    logging_state["listener"] = logging.handlers.QueueListener(
+        queue_handler.queue, stream_handler, file_handler, LogBufferHandler(), respect_handler_level=True)
+    logging_state["listener"].start()
+
+
+def stop_logging():
+    if logging_state["listener"]:
+        logging_state["listener"].stop()
+        logging_state["listener"] = None
+        logging.getLogger().handlers[:] = logging_state["handlers"]
+
+
+metadata_file = "modules_meta.json"
+metadata_db_file = "modules.db"
+STATE_FLUSH_DELAY = 0.5
+
+json_state = {}
+json_dirty = set()
+json_locks = {}
+state_flush = {"task": None, "lock": None}
+module_metadata = {}
+metadata_db = {"connection": None}
+
+
+async def read_json(file_name, default=None):
+    if file_name not in json_state:
+        if default is not None and not os.path.exists(file_name):
+            return copy.deepcopy(default)
+        async with aiofiles.open(file_name, mode='r') as file:
+            content = await file.read()
+        json_state[file_name] = json.loads(content)
+    return copy.deepcopy(json_state[file_name])
 
 
 async def write_json(file_name, data):
-    async with aiofiles.open(file_name, mode='w') as file:
-        await file.write(json.dumps(data, indent=4))
+    json_state[file_name] = copy.deepcopy(data)
+    json_dirty.add(file_name)
+    if state_flush["task"] is None or state_flush["task"].done():
+        state_flush["task"] = asyncio.ensure_future(flush_state_later())
+
+
+@contextlib.asynccontextmanager
+async def update_json(file_name, default=None):
+    async with json_locks.setdefault(file_name, asyncio.Lock()):
+        data = await read_json(file_name, default)
+        yield data
+        await write_json(file_name, data)
+
+
+def write_json_file(file_name, content):
+    temp_file = f"{file_name}.tmp"
+    with open(temp_file, 'w') as file:
+        file.write(content)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file, file_name)
+
+
+async def flush_state():
+    if state_flush["lock"] is None:
+        state_flush["lock"] = asyncio.Lock()
+    async with state_flush["lock"]:
+        while json_dirty:
+            file_name = json_dirty.pop()
+            await asyncio.to_thread(write_json_file, file_name, json.dumps(json_state[file_name], indent=4))
+
+
+async def flush_state_later():
+    await asyncio.sleep(STATE_FLUSH_DELAY)
+    await flush_state()
+
+
+def open_metadata_db():
+    connection = sqlite3.connect(metadata_db_file, check_same_thread=False)
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS modules "
+        "(name TEXT PRIMARY KEY, version TEXT, hash TEXT, source TEXT, installed_at REAL)")
+    connection.commit()
+    return connection
+
+
+async def load_module_metadata(backend):
+    module_metadata.clear()
+    if backend == "sqlite":
+        metadata_db["connection"] = await asyncio.to_thread(open_metadata_db)
+        rows = await asyncio.to_thread(
+            lambda: metadata_db["connection"].execute("SELECT name, version, hash, source, installed_at FROM modules").fetchall())
+        for name, version, module_hash, source, installed_at in rows:
+            module_metadata[name] = {"version": version, "hash": module_hash, "source": source, "installed_at": installed_at}
+    else:
+        module_metadata.update(await read_json(metadata_file, default={}))
+
+
+def execute_metadata_db(query, params):
+    with metadata_db["connection"]:
+        metadata_db["connection"].execute(query, params)
+
+
+async def set_module_metadata(module_name, source=None):
+    module_file = f"{module_name}.py"
+    entry = {
+        "version": read_module_metadata(module_name).get("version"),
+        "hash": await asyncio.to_thread(file_sha256, module_file) if os.path.exists(module_file) else None,
+        "source": source or module_metadata.get(module_name, {}).get("source"),
+        "installed_at": time.time(),
+    }
+    module_metadata[module_name] = entry
+    if metadata_db["connection"]:
+        await asyncio.to_thread(
+            execute_metadata_db,
+            "INSERT OR REPLACE INTO modules (name, version, hash, source, installed_at) VALUES (?, ?, ?, ?, ?)",
+            (module_name, entry["version"], entry["hash"], entry["source"], entry["installed_at"]))
+    else:
+        await write_json(metadata_file, module_metadata)
+
+
+async def delete_module_metadata(module_name):
+    if module_metadata.pop(module_name, None) is None:
+        return
+    if metadata_db["connection"]:
+        await asyncio.to_thread(execute_metadata_db, "DELETE FROM modules WHERE name = ?", (module_name,))
+    else:
+        await write_json(metadata_file, module_metadata)
+
+
+HTTP_TIMEOUT = 30
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+HTTP_POOL_SIZE = 100
+HTTP_POOL_PER_HOST = 10
+
+http_session = None
+etag_cache = {}
+
+
+def get_http_session():
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_POOL_PER_HOST,
+            ttl_dns_cache=300,
+            keepalive_timeout=60)
+        http_session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+    return http_session
+
+
+async def close_http_session():
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+
+async def http_get(url, use_etag=False, headers=None, timeout=None):
+    headers = dict(headers or {})
+    cached = etag_cache.get(url) if use_etag else None
+    if cached and cached["etag"]:
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached["last_modified"]:
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    for attempt in range(HTTP_RETRIES):
+        try:
+            kwargs = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+            async with get_http_session().get(url, headers=headers, **kwargs) as response:
+                if response.status == 304 and cached:
+                    return 200, cached["body"]
+                if (response.status >= 500 or response.status == 429) and attempt < HTTP_RETRIES - 1:
+                    await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+                    continue
+                body = await response.read()
+                if use_etag and response.status == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+                    etag_cache[url] = {"etag": response.headers.get("ETag"),
+                                       "last_modified": response.headers.get("Last-Modified"), "body": body}
+                return response.status, body
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            if attempt == HTTP_RETRIES - 1:
+                raise
+            await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
+
+
+async def http_get_bytes(url, use_etag=False, timeout=None):
+    status, body = await http_get(url, use_etag=use_etag, timeout=timeout)
+    if status >= 400:
+        raise aiohttp.ClientError(f"HTTP {status} for {url}")
+    return body
+
+
+async def http_get_json(url, use_etag=False, timeout=None):
+    return json.loads(await http_get_bytes(url, use_etag=use_etag, timeout=timeout))
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+MODULE_MAX_SIZE = 1024 * 1024
+BACKUP_MAX_SIZE = 50 * 1024 * 1024
+MODULE_NAME_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+
+class SourceScanner:
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.digest = hashlib.sha256()
+        self.parts = []
+
+    def feed(self, chunk):
+        if b"\x00" in chunk:
+            raise ValueError("binary file, not Python source")
+        self.parts.append(self.decoder.decode(chunk))
+        self.digest.update(chunk)
+
+    def finish(self):
+        self.parts.append(self.decoder.decode(b"", final=True))
+        return "".join(self.parts), self.digest.hexdigest()
+
+
+def format_size(size):
+    return f"{size / 1024 ** 2:.1f} MB" if size >= 1024 ** 2 else f"{size / 1024:.0f} KB"
+
+
+async def http_chunks(url, max_size):
+    async with get_http_session().get(url) as response:
+        if response.status >= 400:
+            raise aiohttp.ClientError(f"HTTP {response.status}")
+        if response.content_length and response.content_length > max_size:
+            raise ValueError(f"file is larger than {format_size(max_size)}")
+        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+            yield chunk
+
+
+async def telegram_chunks(client, message, max_size):
+    if message.document.file_size and message.document.file_size > max_size:
+        raise ValueError(f"file is larger than {format_size(max_size)}")
+    async for chunk in client.stream_media(message):
+        yield chunk
+
+
+async def stream_download(chunks, file_path, max_size, scanner=None):
+    size = 0
+    file = await aiofiles.open(file_path, "wb") if file_path else None
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_size:
+                raise ValueError(f"file is larger than {format_size(max_size)}")
+            if scanner:
+                scanner.feed(chunk)
+            if file:
+                await file.write(chunk)
+    except BaseException:
+        if file:
+            await file.close()
+            os.remove(file_path)
+        raise
+    finally:
+        await chunks.aclose()
+    if file:
+        await file.close()
+    return size
+
+
+def module_file_name(file_name):
+    module_name = os.path.basename(file_name.replace("\\", "/"))[:-3]
+    if not file_name.endswith(".py") or not MODULE_NAME_RE.fullmatch(module_name):
+        raise ValueError(f"`{file_name}` is not a valid module file name")
+    return module_name
+
+
+OUTBOX_METHODS = (
+    "send_message", "edit_message_text", "edit_message_caption", "edit_message_media",
+    "send_document", "send_photo", "send_video", "send_animation", "send_audio", "send_voice",
+    "send_sticker", "forward_messages", "copy_message", "delete_messages",
+)
+OUTBOX_EDIT_METHODS = {"edit_message_text", "edit_message_caption", "edit_message_media"}
+OUTBOX_PACED_METHODS = set(OUTBOX_METHODS) - OUTBOX_EDIT_METHODS - {"delete_messages"}
+OUTBOX_GLOBAL_RATE = 25
+OUTBOX_CHAT_BURST = 3
+OUTBOX_CHAT_RATE = 1.0
+MESSAGE_LIMIT = 4096
+
+
+def install_outbox(app):
+    state = {
+        "pending": collections.deque(),
+        "edits": {},
+        "busy": set(),
+        "ready": {},
+        "tokens": {},
+        "sent": collections.deque(),
+        "wake": asyncio.Event(),
+        "task": None,
+    }
+    for name in OUTBOX_METHODS:
+        setattr(app, name, make_scheduled_method(state, name, getattr(app, name)))
+    return state
+
+
+def make_scheduled_method(state, name, original):
+    signature = inspect.signature(original)
+
+    async def scheduled_method(*args, **kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        return await enqueue_outbox(state, name, original, arguments)
+
+    scheduled_method.__name__ = name
+    return scheduled_method
+
+
+def enqueue_outbox(state, name, original, arguments):
+    chat_id = arguments.get("chat_id")
+    key = (name, chat_id, arguments.get("message_id")) if name in OUTBOX_EDIT_METHODS else None
+    if key in state["edits"]:
+        state["edits"][key]["arguments"] = arguments
+        return state["edits"][key]["future"]
+
+    item = {"name": name, "original": original, "arguments": arguments, "chat_id": chat_id, "key": key,
+            "future": asyncio.get_running_loop().create_future()}
+    state["pending"].append(item)
+    if key:
+        state["edits"][key] = item
+    if state["task"] is None or state["task"].done():
+        state["task"] = asyncio.create_task(run_outbox(state))
+    state["wake"].set()
+    return item["future"]
+
+
+async def deliver_outbox_item(state, item):
+    chat_id = item["chat_id"]
+    try:
+        result = await item["original"](**item["arguments"])
+    except FloodWait as e:
+        logger.warning(f"FloodWait of {e.value}s in chat {chat_id}, rescheduling {item['name']}")
+        state["ready"][chat_id] = time.monotonic() + e.value
+        newer = state["edits"].get(item["key"]) if item["key"] else None
+        if newer:
+            newer["future"].add_done_callback(
+                lambda future: item["future"].set_exception(future.exception()) if future.exception()
+                else item["future"].set_result(future.result()))
+        else:
+            state["pending"].appendleft(item)
+            if item["key"]:
+                state["edits"][item["key"]] = item
+    except Exception as e:
+        item["future"].set_exception(e)
+    else:
+        item["future"].set_result(result)
+    finally:
+        state["busy"].discard(chat_id)
+        state["wake"].set()
+
+
+def chat_tokens(state, chat_id, now):
+    tokens, updated = state["tokens"].get(chat_id, (OUTBOX_CHAT_BURST, now))
+    return min(OUTBOX_CHAT_BURST, tokens + (now - updated) * OUTBOX_CHAT_RATE)
+
+
+async def run_outbox(state):
+    while state["pending"] or state["busy"]:
+        state["wake"].clear()
+        now = time.monotonic()
+        while state["sent"] and now - state["sent"][0] >= 1:
+            state["sent"].popleft()
+        if len(state["ready"]) > 1000:
+            state["ready"] = {chat_id: ready for chat_id, ready in state["ready"].items() if ready > now}
+        if len(state["tokens"]) > 1000:
+            state["tokens"] = {chat_id: bucket for chat_id, bucket in state["tokens"].items()
+                               if chat_tokens(state, chat_id, now) < OUTBOX_CHAT_BURST}
+
+        delay = None
+        if len(state["sent"]) >= OUTBOX_GLOBAL_RATE:
+            delay = 1 - (now - state["sent"][0])
+        else:
+            waiting = set()
+            for item in state["pending"]:
+                chat_id = item["chat_id"]
+                if chat_id in state["busy"] or chat_id in waiting:
+                    continue
+                wait = state["ready"].get(chat_id, 0) - now
+                if item["name"] in OUTBOX_PACED_METHODS:
+                    wait = max(wait, (1 - chat_tokens(state, chat_id, now)) / OUTBOX_CHAT_RATE)
+                if wait > 0:
+                    waiting.add(chat_id)
+                    delay = wait if delay is None else min(delay, wait)
+                    continue
+                state["pending"].remove(item)
+                if item["key"] and state["edits"].get(item["key"]) is item:
+                    del state["edits"][item["key"]]
+                if item["name"] in OUTBOX_PACED_METHODS:
+                    state["tokens"][chat_id] = (chat_tokens(state, chat_id, now) - 1, now)
+                state["busy"].add(chat_id)
+                state["sent"].append(now)
+                asyncio.create_task(deliver_outbox_item(state, item))
+                delay = 0
+                break
+
+        if delay == 0:
+            continue
+        try:
+            await asyncio.wait_for(state["wake"].wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
 
-async def init_bot():
-    if not os.path.exists(modules_file):
-        async with aiofiles.open(modules_file, 'w') as file:
-            await file.write(json.dumps([], indent=4))
 
-    if not os.path.exists(config_file):
+accounts = {}
+
+
+async def init_bot(account_dir=None):
+    get_http_session()
+    account_config_file = os.path.join(account_dir, config_file) if account_dir else config_file
+    account_modules_file = os.path.join(account_dir, modules_file) if account_dir else modules_file
+
+    if not os.path.exists(account_modules_file):
+        await write_json(account_modules_file, [])
+
+    if not os.path.exists(account_config_file):
+        if account_dir:
+            print(f"Setting up account {os.path.basename(os.path.normpath(account_dir))}")
         api_id = input("Enter API ID: ")
         api_hash = input("Enter API Hash: ")
         prefix = input("Enter the prefix for commands (e.g., !help or .help): ")
 
         config_data = {"api_id": api_id, "api_hash": api_hash, "prefix": prefix}
-        await write_json(config_file, config_data)
+        await write_json(account_config_file, config_data)
     else:
-        config_data = await read_json(config_file)
-
-    app = Client("yuki_userbot", api_id=config_data['api_id'], api_hash=config_data['api_hash'])
+        config_data = await read_json(account_config_file)
+
+    if not accounts:
+        await load_module_metadata(config_data.get("metadata_backend", "json"))
+    await flush_state()
+
+    if config_data.get("watchdog"):
+        start_watchdog()
+
+    client_options = {"workdir": account_dir} if account_dir else {}
+    app = Client("yuki_userbot", api_id=config_data['api_id'], api_hash=config_data['api_hash'], **client_options)
+    accounts[app] = {
+        "name": os.path.basename(os.path.normpath(account_dir)) if account_dir else "default",
+        "dir": account_dir or ".",
+        "config_file": account_config_file,
+        "modules_file": account_modules_file,
+        "registry": {},
+        "help_cache": {},
+        "core_handlers": [],
+        "isolated_modules": set(config_data.get("isolated_modules", [])),
+    }
+    install_outbox(app)
+    install_dispatcher(app, config_data['prefix'])
     return app, config_data['prefix']
 
 
-async def load_modules():
-    modules = []
-    damaged_modules = []
-    modules_list = await read_json(modules_file)
-    for module_name in modules_list:
+METRICS_FILE = "metrics.prom"
+METRICS_EXPORT_INTERVAL = 0
+METRICS_SAMPLES = 1000
+LOOP_LAG_INTERVAL = 1
+
+handler_metrics = {}
+loop_lag = {"last": 0.0, "max": 0.0}
+
+
+def record_handler(source, command, duration, failed):
+    metric = handler_metrics.get((source, command))
+    if metric is None:
+        metric = handler_metrics[(source, command)] = {
+            "count": 0, "errors": 0, "total": 0.0, "samples": collections.deque(maxlen=METRICS_SAMPLES)}
+    metric["count"] += 1
+    metric["errors"] += failed
+    metric["total"] += duration
+    metric["samples"].append(duration)
+
+
+def percentile(samples, quantile):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+
+def instrument_callback(callback, source):
+    def command_name(args):
+        command = getattr(args[0], "command", None) if args else None
+        return command[0] if command else callback.__name__
+
+    def handler_context(client, source, args):
+        chat = getattr(args[0], "chat", None) if args else None
+        account = accounts.get(client)
+        return log_context.set({
+            "account": account["name"] if account else None,
+            "source_module": source,
+            "command": command_name(args),
+            "chat": getattr(chat, "id", None),
+        })
+
+    def finish_handler(source, args, started, error=None):
+        duration = time.perf_counter() - started
+        command = command_name(args)
+        record_handler(source, command, duration, error is not None)
+        extra = {"duration": round(duration * 1000, 2)}
+        if error is not None:
+            extra["error"] = f"{type(error).__name__}: {str(error)}"
+            logger.error(f"Handler {source}.{command} failed", exc_info=error, extra=extra)
+        elif args and getattr(args[0], "command", None):
+            logger.info(f"Command {command} handled by {source}", extra=extra)
+
+    if inspect.iscoroutinefunction(callback):
+        @functools.wraps(callback)
+        async def timed_callback(client, *args):
+            started = time.perf_counter()
+            token = handler_context(client, source, args)
+            try:
+                result = await callback(client, *args)
+            except (StopPropagation, ContinuePropagation):
+                raise
+            except Exception as e:
+                finish_handler(source, args, started, e)
+                raise
+            else:
+                finish_handler(source, args, started)
+            finally:
+                log_context.reset(token)
+            return result
+    else:
+        @functools.wraps(callback)
+        def timed_callback(client, *args):
+            started = time.perf_counter()
+            token = handler_context(client, source, args)
+            try:
+                result = callback(client, *args)
+            except (StopPropagation, ContinuePropagation):
+                raise
+            except Exception as e:
+                finish_handler(source, args, started, e)
+                raise
+            else:
+                finish_handler(source, args, started)
+            finally:
+                log_context.reset(token)
+            return result
+    return timed_callback
+
+
+async def monitor_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        loop_lag["last"] = max(time.perf_counter() - started - LOOP_LAG_INTERVAL, 0.0)
+        loop_lag["max"] = max(loop_lag["max"], loop_lag["last"])
+
+
+def format_prometheus_metrics():
+    lines = ["# TYPE yuki_startup_seconds gauge"]
+    for phase, duration in startup_stats.items():
+        lines.append(f'yuki_startup_seconds{{phase="{phase}"}} {duration:.6f}')
+
+    lines.append("# TYPE yuki_handler_latency_seconds summary")
+    for (source, command), metric in handler_metrics.items():
+        labels = f'source="{source}",command="{command}"'
+        for quantile in (0.5, 0.95, 0.99):
+            lines.append(f'yuki_handler_latency_seconds{{{labels},quantile="{quantile}"}} {percentile(metric["samples"], quantile):.6f}')
+        lines.append(f'yuki_handler_latency_seconds_sum{{{labels}}} {metric["total"]:.6f}')
+        lines.append(f'yuki_handler_latency_seconds_count{{{labels}}} {metric["count"]}')
+
+    lines.append("# TYPE yuki_handler_errors_total counter")
+    for (source, command), metric in handler_metrics.items():
+        lines.append(f'yuki_handler_errors_total{{source="{source}",command="{command}"}} {metric["errors"]}')
+
+    lines.append("# TYPE yuki_loop_lag_seconds gauge")
+    lines.append(f'yuki_loop_lag_seconds{{kind="last"}} {loop_lag["last"]:.6f}')
+    lines.append(f'yuki_loop_lag_seconds{{kind="max"}} {loop_lag["max"]:.6f}')
+    return "\n".join(lines) + "\n"
+
+
+async def export_metrics():
+    await write_file_atomic(METRICS_FILE, format_prometheus_metrics().encode("utf-8"))
+
+
+async def export_metrics_periodically():
+    while True:
+        await asyncio.sleep(METRICS_EXPORT_INTERVAL)
+        try:
+            await export_metrics()
+        except OSError as e:
+            logger.warning(f"Failed to export metrics: {str(e)}")
+
+
+WATCHDOG_INTERVAL = 0.5
+WATCHDOG_THRESHOLD = 1.0
+
+watchdog_state = {"thread": None, "stop": None}
+loop_stalls = collections.deque(maxlen=50)
+
+
+def find_stall_owner(frame):
+    while frame is not None:
+        if frame.f_code.co_name == "timed_callback" and frame.f_code.co_filename == __file__:
+            args = frame.f_locals.get("args") or ()
+            command = getattr(args[0], "command", None) if args else None
+            return frame.f_locals.get("source"), command[0] if command else frame.f_locals["callback"].__name__
+        frame = frame.f_back
+    return None, None
+
+
+def watch_event_loop(loop, thread_id, stop_event):
+    while not stop_event.wait(WATCHDOG_INTERVAL):
+        beat = threading.Event()
+        sent = time.monotonic()
+        try:
+            loop.call_soon_threadsafe(beat.set)
+        except RuntimeError:
+            return
+        if beat.wait(WATCHDOG_THRESHOLD):
+            continue
+
+        frame = sys._current_frames().get(thread_id)
+        source, command = find_stall_owner(frame)
+        stack = "".join(traceback.format_stack(frame)[-6:]) if frame else ""
+        del frame
+        while not beat.wait(WATCHDOG_INTERVAL) and not stop_event.is_set():
+            pass
+
+        stall = {"time": time.time(), "duration": time.monotonic() - sent, "source": source or "unknown",
+                 "command": command or "unknown", "stack": stack}
+        loop_stalls.append(stall)
+        logger.warning(f"Event loop blocked for {stall['duration']:.2f}s by {stall['source']}.{stall['command']}\n{stack}")
+
+
+def start_watchdog():
+    if watchdog_state["thread"] and watchdog_state["thread"].is_alive():
+        return
+    watchdog_state["stop"] = threading.Event()
+    watchdog_state["thread"] = threading.Thread(
+        target=watch_event_loop,
+        args=(asyncio.get_running_loop(), threading.get_ident(), watchdog_state["stop"]),
+        name="yuki-watchdog",
+        daemon=True)
+    watchdog_state["thread"].start()
+
+
+def stop_watchdog():
+    if watchdog_state["stop"]:
+        watchdog_state["stop"].set()
+    watchdog_state["thread"] = None
+
+
+COMMAND_ARGUMENTS_RE = re.compile(r"([\"'])(.*?)(?<!\\)\1|(\S+)")
+
+command_dispatchers = {}
+
+
+def parse_command(text, prefix, username=None):
+    if not text or not text.startswith(prefix):
+        return None
+    parts = text[len(prefix):].split(maxsplit=1)
+    if not parts:
+        return None
+    name, _, mention = parts[0].lower().partition("@")
+    if mention and mention != (username or "").lower():
+        return None
+    arguments = parts[1] if len(parts) > 1 else ""
+    return [name] + [re.sub(r"\\([\"'])", r"\1", match.group(2) or match.group(3) or "")
+                     for match in COMMAND_ARGUMENTS_RE.finditer(arguments)]
+
+
+def install_dispatcher(app, yuki_prefix):
+    state = command_dispatchers[app] = {"prefix": yuki_prefix, "commands": {}}
+    app.on_command = make_command_decorator(app)
+
+    async def match_command(_, client, message):
+        if not (message.outgoing or (message.from_user and message.from_user.is_self)):
+            return False
+        command = parse_command(message.text or message.caption, state["prefix"], client.me.username if client.me else None)
+        if not command or command[0] not in state["commands"]:
+            return False
+        message.command = command
+        return True
+
+    async def dispatch_command(client, message):
+        callback = state["commands"][message.command[0]]["callback"]
+        if inspect.iscoroutinefunction(callback):
+            await callback(client, message)
+        else:
+            await asyncio.get_running_loop().run_in_executor(client.executor, callback, client, message)
+
+    Client.add_handler(app, pyrogram.handlers.MessageHandler(dispatch_command, filters.create(match_command)), 0)
+    return state
+
+
+def add_command(app, names, callback, source=None, handlers=None):
+    entry = {"names": [name.lower() for name in names],
+             "callback": instrument_callback(callback, source) if source else callback}
+    for name in entry["names"]:
+        command_dispatchers[app]["commands"][name] = entry
+    if handlers is not None:
+        handlers.append((entry, None))
+    return entry
+
+
+def remove_command(app, entry):
+    commands = command_dispatchers[app]["commands"]
+    for name in entry["names"]:
+        if commands.get(name) is entry:
+            del commands[name]
+
+
+def make_command_decorator(app, source=None, handlers=None):
+    def on_command(*names):
+        def decorator(func):
+            add_command(app, names, func, source, handlers)
+            return func
+        return decorator
+    return on_command
+
+
+def legacy_command_names(app, handler, group):
+    if group != 0 or not isinstance(handler, pyrogram.handlers.MessageHandler) \
+            or not isinstance(handler.filters, pyrogram.filters.AndFilter):
+        return None
+    parts = [handler.filters.base, handler.filters.other]
+    if filters.me not in parts:
+        return None
+    parts.remove(filters.me)
+    command_filter = parts[0]
+    state = command_dispatchers[app]
+    if type(command_filter).__name__ != "CommandFilter" or command_filter.case_sensitive \
+            or command_filter.prefixes != {state["prefix"]} \
+            or any(name in state["commands"] for name in command_filter.commands):
+        return None
+    return sorted(command_filter.commands)
+
+
+async def capture_handlers(app, register, *args, source=None):
+    handlers = []
+
+    def add_handler(handler, group=0):
+        names = legacy_command_names(app, handler, group)
+        if names:
+            add_command(app, names, handler.callback, source, handlers)
+            return handler, group
+        if source:
+            handler.callback = instrument_callback(handler.callback, source)
+        handlers.append((handler, group))
+        return Client.add_handler(app, handler, group)
+
+    app.add_handler = add_handler
+    app.on_command = make_command_decorator(app, source, handlers)
+    try:
+        result = register(app, *args)
+        if asyncio.iscoroutine(result):
+            await result
+    except Exception:
+        remove_handlers(app, handlers)
+        raise
+    finally:
+        del app.add_handler
+        app.on_command = make_command_decorator(app)
+    return handlers
+
+
+def remove_handlers(app, handlers):
+    for handler, group in handlers:
+        if group is None:
+            remove_command(app, handler)
+        else:
+            app.remove_handler(handler, group)
+
+
+def set_registry_entry(app, module_name, module=None, handlers=None, error=None, status=None, cinfo=None):
+    accounts[app]["registry"][module_name] = {
+        "name": module_name,
+        "module": module,
+        "handlers": handlers or [],
+        "cinfo": cinfo if cinfo is not None else getattr(module, 'cinfo', ''),
+        "status": status or ("damaged" if error else "loaded"),
+        "error": error,
+    }
+    accounts[app]["help_cache"].clear()
+
+
+async def import_single_module(app, module_name, reload=True):
+    entry = accounts[app]["registry"].pop(module_name, None)
+    if entry:
+        remove_handlers(app, entry["handlers"])
+        accounts[app]["help_cache"].clear()
+
+    if module_name in accounts[app]["isolated_modules"]:
         try:
+            handlers, cinfo = await start_isolated_module(app, module_name)
+        except Exception as e:
+            set_registry_entry(app, module_name, error=str(e))
+            if isinstance(e, ImportError):
+                schedule_dependencies(app, module_name)
+            raise
+        set_registry_entry(app, module_name, handlers=handlers, status="isolated", cinfo=cinfo)
+        return None
+
+    try:
+        importlib.invalidate_caches()
+        if module_name in sys.modules:
+            module = importlib.reload(sys.modules[module_name]) if reload else sys.modules[module_name]
+        else:
             module = importlib.import_module(module_name)
-            modules.append(module)
+
+        handlers = []
+        if hasattr(module, 'register_module'):
+            handlers = await capture_handlers(app, module.register_module, source=module_name)
+    except Exception as e:
+        set_registry_entry(app, module_name, error=str(e))
+        if isinstance(e, ImportError):
+            schedule_dependencies(app, module_name)
+        raise
+
+    set_registry_entry(app, module_name, module, handlers)
+    return module
+
+
+def read_module_metadata(module_name):
+    metadata = {}
+    try:
+        with open(f"{module_name}.py", encoding="utf-8") as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                if not line.startswith("#"):
+                    break
+                key, separator, value = line[1:].partition(":")
+                if separator:
+                    metadata[key.strip().lower()] = value.strip()
+    except OSError:
+        pass
+    return metadata
+
+
+DEPENDENCIES_DIR = "packages"
+WHEEL_CACHE_DIR = "wheels"
+PIP_TIMEOUT = 600
+REQUIREMENT_RE = re.compile(r"([A-Za-z0-9][A-Za-z0-9._-]*)(\[[A-Za-z0-9._,\s-]*\])?\s*([<>=!~]=?\s*[A-Za-z0-9.*+!_-]+\s*(,\s*[<>=!~]=?\s*[A-Za-z0-9.*+!_-]+\s*)*)?")
+
+dependency_tasks = {}
+dependency_attempts = {}
+dependency_lock = None
+
+sys.path.insert(next((index for index, path in enumerate(sys.path) if os.path.basename(path) in ("site-packages", "dist-packages")),
+                     len(sys.path)), os.path.abspath(DEPENDENCIES_DIR))
+
+
+def module_requirements(module_name):
+    requires = read_module_metadata(module_name).get("requires", "")
+    requirements = [requirement for requirement in re.split(r"\s*,\s*(?=[A-Za-z0-9])", requires) if requirement]
+    for requirement in requirements:
+        if not REQUIREMENT_RE.fullmatch(requirement):
+            raise ValueError(f"invalid requirement `{requirement}`")
+    return requirements
+
+
+def requirement_installed(requirement):
+    match = REQUIREMENT_RE.match(requirement)
+    try:
+        version = importlib.metadata.version(match.group(1))
+    except importlib.metadata.PackageNotFoundError:
+        return False
+    specifier = re.sub(r"\s+", "", match.group(3) or "")
+    if not specifier:
+        return True
+    try:
+        from packaging.specifiers import SpecifierSet
+    except ImportError:
+        return True
+    try:
+        return SpecifierSet(specifier).contains(version, prereleases=True)
+    except ValueError:
+        return False
+
+
+async def run_pip(*args):
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "pip", *args, "--disable-pip-version-check", "--no-input",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout=PIP_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise RuntimeError("pip timed out")
+    return process.returncode, output.decode("utf-8", errors="replace")
+
+
+async def install_requirements(requirements):
+    global dependency_lock
+    if dependency_lock is None:
+        dependency_lock = asyncio.Lock()
+    async with dependency_lock:
+        missing = [requirement for requirement in requirements if not requirement_installed(requirement)]
+        if not missing:
+            return []
+
+        os.makedirs(WHEEL_CACHE_DIR, exist_ok=True)
+        install = ("install", "--target", DEPENDENCIES_DIR, "--no-index", "--find-links", WHEEL_CACHE_DIR, *missing)
+        return_code, output = await run_pip(*install)
+        if return_code != 0:
+            return_code, output = await run_pip("wheel", "--wheel-dir", WHEEL_CACHE_DIR, "--find-links", WHEEL_CACHE_DIR, *missing)
+            if return_code == 0:
+                return_code, output = await run_pip(*install)
+        if return_code != 0:
+            raise RuntimeError(output.strip().splitlines()[-1] if output.strip() else f"pip exited with code {return_code}")
+
+        importlib.invalidate_caches()
+        return missing
+
+
+async def resolve_dependencies(app, module_name, requirements):
+    try:
+        installed = await install_requirements(requirements)
+        logger.info(f"Installed dependencies for {module_name}: {', '.join(installed) or 'already present'}")
+    except Exception as e:
+        logger.error(f"Failed to install dependencies for {module_name}: {str(e)}")
+        for account in accounts.values():
+            entry = account["registry"].get(module_name)
+            if entry and entry["status"] == "damaged":
+                entry["error"] = f"{entry['error']} (installing {', '.join(requirements)} failed: {str(e)})"
+        raise
+    finally:
+        dependency_tasks.pop(module_name, None)
+        for account in accounts.values():
+            account["help_cache"].clear()
+
+    retried = []
+    damaged = [(account_app, name) for account_app, account in accounts.items()
+               for name, entry in account["registry"].items() if entry["status"] == "damaged"]
+    for account_app, name in damaged:
+        if name in dependency_tasks:
+            continue
+        try:
+            if name != module_name:
+                try:
+                    requirements = module_requirements(name)
+                except ValueError:
+                    continue
+                if not requirements or not all(map(requirement_installed, requirements)):
+                    continue
+            await import_single_module(account_app, name)
+            retried.append(name)
         except Exception as e:
-            damaged_modules.append((module_name, str(e)))
-    return modules, damaged_modules
+            logger.error(f"An error occurred while retrying module {name}: {str(e)}")
+    return retried
+
+
+def schedule_dependencies(app, module_name):
+    if module_name in dependency_tasks:
+        return dependency_tasks[module_name]
+    try:
+        requirements = module_requirements(module_name)
+    except ValueError as e:
+        logger.error(f"Module {module_name} has invalid requirements: {str(e)}")
+        return None
+    if not requirements or dependency_attempts.get(module_name) == requirements \
+            or all(map(requirement_installed, requirements)):
+        return None
+
+    dependency_attempts[module_name] = requirements
+    for account in accounts.values():
+        account["help_cache"].clear()
+    task = dependency_tasks[module_name] = asyncio.ensure_future(resolve_dependencies(app, module_name, requirements))
+    return task
+
+
+async def report_dependencies(app, message, module_name, task):
+    try:
+        await task
+    except Exception as e:
+        await message.reply_text(f"<emoji id=5465665476971471368>❌</emoji> Failed to install dependencies for `{module_name}`: {str(e)}")
+        return
+    entry = accounts[app]["registry"].get(module_name)
+    if entry and entry["status"] != "damaged":
+        await message.reply_text(f"<emoji id=5427009714745517609>✅</emoji> Dependencies installed, module `{module_name}` loaded.")
+    else:
+        await message.reply_text(f"<emoji id=5467928559664242360>❗️</emoji> Dependencies installed, but `{module_name}` still failed to load: {entry['error'] if entry else 'unknown error'}")
+
+
+lazy_locks = {}
+
+
+async def activate_lazy_module(app, module_name, client, message):
+    registry = accounts[app]["registry"]
+    async with lazy_locks.setdefault(module_name, asyncio.Lock()):
+        if registry.get(module_name, {}).get("status") == "lazy":
+            await import_single_module(app, module_name, reload=False)
+
+    for handler, group in registry[module_name]["handlers"]:
+        if group is None:
+            if message.command[0] not in handler["names"]:
+                continue
+            callback = handler["callback"]
+        elif await handler.check(client, message):
+            callback = handler.callback
+        else:
+            continue
+        result = callback(client, message)
+        if inspect.isawaitable(result):
+            await result
+        break
+
+
+async def register_lazy_module(app, module_name, commands, yuki_prefix, cinfo=""):
+    entry = accounts[app]["registry"].pop(module_name, None)
+    if entry:
+        remove_handlers(app, entry["handlers"])
+
+    def register(app):
+        @app.on_command(*commands)
+        async def _lazy_module_command(client, message):
+            await activate_lazy_module(app, module_name, client, message)
+
+    handlers = await capture_handlers(app, register)
+    set_registry_entry(app, module_name, handlers=handlers, status="lazy", cinfo=cinfo)
+
+
+async def load_single_module(app, module_name, yuki_prefix, reload=True):
+    metadata = read_module_metadata(module_name)
+    commands = [command.strip() for command in metadata.get("commands", "").split(",") if command.strip()]
+    if commands and module_name not in sys.modules and module_name not in accounts[app]["isolated_modules"]:
+        await register_lazy_module(app, module_name, commands, yuki_prefix, metadata.get("cinfo", ""))
+    else:
+        await import_single_module(app, module_name, reload)
+
+
+ISOLATED_MEMORY_LIMIT = 512 * 1024 * 1024
+ISOLATED_CPU_LIMIT = 3600
+ISOLATED_TIMEOUT = 300
+ISOLATED_MAX_RESTARTS = 5
+ISOLATED_RESTART_DELAY = 5
+ISOLATED_GROUP = 1000
+ISOLATED_BLOCKED_METHODS = {"delete_account", "reset_authorizations", "get_authorizations", "log_out", "export_session_string"}
+
+isolated_workers = {}
+isolated_groups = itertools.count(ISOLATED_GROUP)
+
+
+def serialize_message(message, depth=0):
+    if message is None:
+        return None
+    document = message.document
+    return {
+        "id": message.id,
+        "chat": {"id": message.chat.id, "type": message.chat.type.name if message.chat.type else None,
+                 "title": message.chat.title, "username": message.chat.username} if message.chat else None,
+        "from_user": {"id": message.from_user.id, "is_self": message.from_user.is_self, "is_bot": message.from_user.is_bot,
+                      "first_name": message.from_user.first_name, "username": message.from_user.username} if message.from_user else None,
+        "outgoing": message.outgoing,
+        "text": str(message.text) if message.text else None,
+        "caption": str(message.caption) if message.caption else None,
+        "media": message.media.name if message.media else None,
+        "date": message.date.timestamp() if message.date else None,
+        "document": {"file_id": document.file_id, "file_name": document.file_name,
+                     "mime_type": document.mime_type, "file_size": document.file_size} if document else None,
+        "reply_to_message": serialize_message(message.reply_to_message, depth + 1) if depth == 0 else None,
+    }
+
+
+def serialize_result(worker, result):
+    if isinstance(result, pyrogram.types.Message):
+        remember_worker_message(worker, result)
+        return {"__message__": serialize_message(result)}
+    if isinstance(result, (list, tuple)):
+        return [serialize_result(worker, item) for item in result]
+    if result is None or isinstance(result, (str, int, float, bool)):
+        return result
+    return str(result)
+
+
+def remember_worker_message(worker, message):
+    if message.chat:
+        worker["messages"][(message.chat.id, message.id)] = message
+        while len(worker["messages"]) > 200:
+            worker["messages"].popitem(last=False)
+
+
+def limit_worker_resources():
+    os.nice(10)
+    resource.setrlimit(resource.RLIMIT_AS, (ISOLATED_MEMORY_LIMIT, ISOLATED_MEMORY_LIMIT))
+    resource.setrlimit(resource.RLIMIT_CPU, (ISOLATED_CPU_LIMIT, ISOLATED_CPU_LIMIT))
+
+
+async def send_to_worker(worker, data):
+    process = worker["process"]
+    process.stdin.write(json.dumps(data).encode("utf-8") + b"\n")
+    await process.stdin.drain()
+
+
+async def execute_worker_call(worker, data):
+    try:
+        if data["method"] in ISOLATED_BLOCKED_METHODS or data["method"].startswith("_"):
+            raise PermissionError(f"{data['method']} is not allowed for isolated modules")
+        target = worker["app"]
+        if data["target"] == "message":
+            chat_id, message_id = data["message"]
+            target = worker["messages"].get((chat_id, message_id)) or await worker["app"].get_messages(chat_id, message_id)
+        result = getattr(target, data["method"])(*data["args"], **data["kwargs"])
+        if inspect.isawaitable(result):
+            result = await result
+        response = {"type": "result", "id": data["id"], "result": serialize_result(worker, result)}
+    except Exception as e:
+        response = {"type": "error", "id": data["id"], "error": f"{type(e).__name__}: {str(e)}"}
+    try:
+        await send_to_worker(worker, response)
+    except (ConnectionError, AttributeError):
+        pass
+
+
+async def read_worker(worker):
+    process = worker["process"]
+    while True:
+        line = await process.stdout.readline()
+        if not line:
+            break
+        data = json.loads(line)
+        if data["type"] == "done":
+            finish_worker_update(worker, data["id"], data.get("error"))
+        elif data["type"] == "call":
+            asyncio.create_task(execute_worker_call(worker, data))
+
+    await process.wait()
+    for update_id in list(worker["pending"]):
+        finish_worker_update(worker, update_id, f"worker {worker['name']} exited")
+    worker["process"] = None
+
+    if not worker["stopping"] and worker["restarts"] < ISOLATED_MAX_RESTARTS:
+        worker["restarts"] += 1
+        logger.warning(f"Isolated module {worker['name']} exited with code {process.returncode}, restarting")
+        await asyncio.sleep(ISOLATED_RESTART_DELAY)
+        try:
+            await spawn_worker(worker)
+        except Exception as e:
+            logger.error(f"Failed to restart isolated module {worker['name']}: {str(e)}")
+
+
+async def spawn_worker(worker):
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), "--worker", worker["name"],
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        limit=16 * 1024 * 1024)
+    line = await asyncio.wait_for(process.stdout.readline(), timeout=60)
+    ready = json.loads(line) if line else {"type": "error", "error": "worker exited during startup"}
+    if ready["type"] != "ready":
+        process.kill()
+        await process.wait()
+        raise ImportError(ready["error"])
+    worker["process"] = process
+    worker["reader"] = asyncio.create_task(read_worker(worker))
+    return ready["cinfo"]
+
+
+def finish_worker_update(worker, update_id, error=None):
+    pending = worker["pending"].pop(update_id, None)
+    if pending is None:
+        return
+    pending["timer"].cancel()
+    record_handler(worker["name"], "worker_update", time.perf_counter() - pending["started"], error is not None)
+    if error:
+        logger.error(f"Isolated module {worker['name']} failed to handle an update: {error}")
+
+
+async def dispatch_to_worker(worker, message):
+    if worker["process"] is None:
+        return
+    update_id = next(worker["ids"])
+    remember_worker_message(worker, message)
+    me = worker["app"].me
+    worker["pending"][update_id] = {
+        "started": time.perf_counter(),
+        "timer": asyncio.get_running_loop().call_later(
+            ISOLATED_TIMEOUT, finish_worker_update, worker, update_id, f"timed out after {ISOLATED_TIMEOUT}s"),
+    }
+    try:
+        await send_to_worker(worker, {
+            "type": "update",
+            "id": update_id,
+            "message": serialize_message(message),
+            "me": {"id": me.id, "username": me.username} if me else None,
+            "prefix": command_dispatchers[worker["app"]]["prefix"],
+        })
+    except Exception as e:
+        finish_worker_update(worker, update_id, str(e))
+        raise
+
+
+async def start_isolated_module(app, module_name):
+    await stop_isolated_module(app, module_name)
+    worker = {
+        "name": module_name,
+        "app": app,
+        "process": None,
+        "reader": None,
+        "pending": {},
+        "messages": collections.OrderedDict(),
+        "ids": itertools.count(1),
+        "restarts": 0,
+        "stopping": False,
+    }
+    cinfo = await spawn_worker(worker)
+    isolated_workers[(app, module_name)] = worker
+    group = next(isolated_groups)
+
+    def register(app):
+        @app.on_message(filters.me & (filters.text | filters.caption), group=group)
+        async def _isolated_module_message(_, message):
+            await dispatch_to_worker(worker, message)
+
+    return await capture_handlers(app, register, source=module_name), cinfo
+
+
+async def stop_isolated_module(app, module_name):
+    worker = isolated_workers.pop((app, module_name), None)
+    if worker:
+        worker["stopping"] = True
+        if worker["process"] and worker["process"].returncode is None:
+            worker["process"].terminate()
+            await worker["process"].wait()
+
+
+class RemoteMessage:
+    def __init__(self, worker, data):
+        self._worker = worker
+        for key, value in data.items():
+            if key == "reply_to_message":
+                value = RemoteMessage(worker, value) if value else None
+            elif key == "chat" and value:
+                value = types.SimpleNamespace(**dict(value, type=enums.ChatType[value["type"]] if value["type"] else None))
+            elif key == "media" and value:
+                value = enums.MessageMediaType[value]
+            elif isinstance(value, dict):
+                value = types.SimpleNamespace(**value)
+            setattr(self, key, value)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not callable(getattr(pyrogram.types.Message, name, None)):
+            return None
+
+        async def remote_method(*args, **kwargs):
+            return await self._worker.call("message", name, args, kwargs, (self.chat.id, self.id))
+        return remote_method
+
+
+class RemoteClient:
+    def __init__(self, send):
+        self._send = send
+        self._pending = {}
+        self._ids = itertools.count(1)
+        self.handlers = []
+        self.me = None
+        self.prefix = None
+
+    def on_message(self, filters=None, group=0):
+        def decorator(func):
+            self.handlers.append((filters, func, group))
+            return func
+        return decorator
+
+    def on_command(self, *names):
+        names = [name.lower() for name in names]
+
+        async def match_command(_, client, message):
+            if not (message.outgoing or (message.from_user and message.from_user.is_self)):
+                return False
+            command = parse_command(message.text or message.caption, client.prefix, client.me.username if client.me else None)
+            if not command or command[0] not in names:
+                return False
+            message.command = command
+            return True
+
+        return self.on_message(filters.create(match_command))
+
+    def add_handler(self, handler, group=0):
+        if isinstance(handler, pyrogram.handlers.MessageHandler):
+            self.handlers.append((handler.filters, handler.callback, group))
+        return handler, group
+
+    def __getattr__(self, name):
+        if name.startswith("on_"):
+            logger.warning(f"{name} handlers are not supported for isolated modules")
+            return lambda *args, **kwargs: (lambda func: func)
+        if name.startswith("_") or not callable(getattr(Client, name, None)):
+            raise AttributeError(name)
+
+        async def remote_method(*args, **kwargs):
+            return await self.call("client", name, args, kwargs)
+        return remote_method
+
+    async def call(self, target, method, args, kwargs, message=None):
+        call_id = next(self._ids)
+        future = self._pending[call_id] = asyncio.get_running_loop().create_future()
+        self._send({"type": "call", "id": call_id, "target": target, "method": method,
+                    "args": list(args), "kwargs": kwargs, "message": message})
+        return await future
+
+    def wrap_result(self, result):
+        if isinstance(result, list):
+            return [self.wrap_result(item) for item in result]
+        if isinstance(result, dict) and "__message__" in result:
+            return RemoteMessage(self, result["__message__"])
+        return result
+
+    def resolve(self, data):
+        future = self._pending.pop(data["id"], None)
+        if future is None or future.done():
+            return
+        if data["type"] == "error":
+            future.set_exception(RuntimeError(data["error"]))
+        else:
+            future.set_result(self.wrap_result(data["result"]))
+
+    async def handle_update(self, data):
+        error = None
+        try:
+            if data["me"]:
+                self.me = types.SimpleNamespace(**data["me"])
+            self.prefix = data["prefix"]
+            message = RemoteMessage(self, data["message"])
+            for _, handlers in itertools.groupby(sorted(self.handlers, key=lambda item: item[2]), key=lambda item: item[2]):
+                for handler_filters, callback, _ in handlers:
+                    if handler_filters is None or await handler_filters(self, message):
+                        result = callback(self, message)
+                        if inspect.isawaitable(result):
+                            await result
+                        break
+        except (StopPropagation, ContinuePropagation):
+            pass
+        except Exception as e:
+            logger.exception(e)
+            error = f"{type(e).__name__}: {str(e)}"
+        self._send({"type": "done", "id": data["id"], "error": error})
+
+
+async def module_worker(module_name):
+    limit_worker_resources()
+    loop = asyncio.get_running_loop()
+    ipc_out = os.fdopen(os.dup(1), "w")
+    os.dup2(2, 1)
+
+    def send(data):
+        ipc_out.write(json.dumps(data) + "\n")
+        ipc_out.flush()
+
+    reader = asyncio.StreamReader(limit=16 * 1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    client = RemoteClient(send)
+    try:
+        sys.path.insert(0, os.getcwd())
+        module = importlib.import_module(module_name)
+        if hasattr(module, 'register_module'):
+            result = module.register_module(client)
+            if inspect.isawaitable(result):
+                await result
+    except Exception as e:
+        send({"type": "error", "error": str(e)})
+        return
+    send({"type": "ready", "cinfo": getattr(module, 'cinfo', '')})
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        data = json.loads(line)
+        if data["type"] == "update":
+            asyncio.create_task(client.handle_update(data))
+        else:
+            client.resolve(data)
+
+
+async def unload_single_module(app, module_name):
+    entry = accounts[app]["registry"].pop(module_name, None)
+    if entry:
+        remove_handlers(app, entry["handlers"])
+        accounts[app]["help_cache"].clear()
+    await stop_isolated_module(app, module_name)
+    if not any(module_name in account["registry"] for account in accounts.values()):
+        sys.modules.pop(module_name, None)
 
 
 RISK_METHODS = {
@@ -73,7 +1520,9 @@ RISK_METHODS = {
         {"command": "get_authorizations", "perms": "get telegram api_id and api_hash"}
     ],
     "warn": [
-        {"command": "log_out", "perms": "disconnect account"}
+        {"command": "log_out", "perms": "disconnect account"},
+        {"command": "os.system", "perms": "run shell commands"},
+        {"command": "subprocess", "perms": "run shell commands"}
     ],
     "not_bad": [
         {"command": "torpy", "perms": "can download viruses"},
@@ -83,57 +1532,265 @@ RISK_METHODS = {
 }
 
 
+RISK_RULES_FILE = "risk_rules.json"
+RISK_SCAN_PROCESS_SIZE = 256 * 1024
+
+risk_cache = {}
+risk_process_pool = None
+risk_rules = {"mtime": None, "regex": None, "patterns": None, "rules": [], "commands": {}, "longest": 0}
+
+RISK_TOKEN_PATTERNS = [
+    r"(?P<from>\bfrom\s+(?P<module>[\w.]+)\s+import\s+(?P<names>\([^)]*\)|[^\n;]*))",
+    r"(?P<name>(?<!\w)[A-Za-z_]\w*(?:\s*\.\s*[A-Za-z_]\w*)*)",
+]
+RISK_STRING_RE = re.compile(r"[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*")
+
+
+def compile_risk_rules(levels):
+    rules = [dict(rule, level=level, order=order)
+             for level, level_rules in levels.items() for order, rule in enumerate(level_rules)]
+    commands = {rule["command"]: index for index, rule in enumerate(rules) if "command" in rule}
+    patterns = [f"(?P<rule{index}>{rule['pattern']})" for index, rule in enumerate(rules) if "command" not in rule]
+    longest = max((command.count(".") + 1 for command in commands), default=0)
+    return (re.compile("|".join(patterns + RISK_TOKEN_PATTERNS)), re.compile("|".join(patterns)) if patterns else None,
+            rules, commands, longest)
+
+
+def match_risk_commands(parts, commands, longest):
+    start = 0
+    while start < len(parts):
+        for end in range(min(len(parts), start + longest), start, -1):
+            index = commands.get(".".join(parts[start:end]))
+            if index is not None:
+                yield index
+                start = end
+                break
+        else:
+            start += 1
+
+
+def load_risk_rules():
+    try:
+        mtime = os.stat(RISK_RULES_FILE).st_mtime_ns
+    except FileNotFoundError:
+        write_json_file(RISK_RULES_FILE, json.dumps(RISK_METHODS, indent=4))
+        mtime = os.stat(RISK_RULES_FILE).st_mtime_ns
+    if mtime == risk_rules["mtime"]:
+        return risk_rules
+
+    try:
+        with open(RISK_RULES_FILE, 'r') as file:
+            compiled = compile_risk_rules(json.load(file))
+    except (ValueError, KeyError, TypeError, AttributeError, re.error) as e:
+        logger.error(f"Invalid risk rules in {RISK_RULES_FILE}, using the previous rules: {str(e)}")
+        compiled = compile_risk_rules(RISK_METHODS) if risk_rules["mtime"] is None else None
+    if compiled:
+        risk_rules["regex"], risk_rules["patterns"], risk_rules["rules"], risk_rules["commands"], risk_rules["longest"] = compiled
+    risk_rules["mtime"] = mtime
+    risk_cache.clear()
+    return risk_rules
+
+
+def resolve_name(node, aliases):
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if not isinstance(node, ast.Name):
+        return None
+    parts.append(aliases.get(node.id, node.id))
+    return ".".join(reversed(parts))
+
+
+def collect_risk_names(code):
+    tree = ast.parse(code)
+    aliases = {}
+    names = []
+    bases = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute):
+            bases.add(id(node.value))
+        elif isinstance(node, ast.Import):
+            for alias in node.names:
+                aliases[alias.asname or alias.name.split(".")[0]] = alias.name if alias.asname else alias.name.split(".")[0]
+                names.append((alias.name, node.lineno))
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names.append((node.module, node.lineno))
+            for alias in node.names:
+                aliases[alias.asname or alias.name] = f"{node.module}.{alias.name}"
+                names.append((f"{node.module}.{alias.name}", node.lineno))
+        elif isinstance(node, ast.Constant) and isinstance(node.value, str) and RISK_STRING_RE.fullmatch(node.value):
+            names.append((node.value, node.lineno))
+
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.Attribute, ast.Name)) and isinstance(node.ctx, ast.Load) and id(node) not in bases:
+            name = resolve_name(node, aliases)
+            if name:
+                names.append((name, node.lineno))
+    return names
+
+
+def match_risk_name(parts, rules):
+    indexes = set(match_risk_commands(parts, rules["commands"], rules["longest"]))
+    indexes.update(rules["commands"][word] for part in parts if "_" in part
+                   for word in part.split("_") if word in rules["commands"])
+    return indexes
+
+
+def scan_risk_text(code, regex, rules):
+    lineno, position = 1, 0
+    for match in regex.finditer(code):
+        lineno += code.count("\n", position, match.start())
+        position = match.start()
+        groups = match.groupdict()
+        if groups.get("from"):
+            module = match.group("module").split(".")
+            names = [name.split()[0] for name in match.group("names").strip("()").split(",") if name.strip()]
+            indexes = {index for name in names for index in match_risk_name(module + [name], rules)}
+        elif groups.get("name"):
+            indexes = match_risk_name(re.split(r"\s*\.\s*", match.group("name")), rules)
+        else:
+            indexes = [int(match.lastgroup[4:])]
+        for index in indexes:
+            yield index, lineno
+
+
 def check_code_for_risk_methods(code):
+    rules = load_risk_rules()
+    try:
+        names = collect_risk_names(code)
+    except (SyntaxError, ValueError):
+        matches = list(scan_risk_text(code, rules["regex"], rules))
+    else:
+        matches = list(scan_risk_text(code, rules["patterns"], rules)) if rules["patterns"] else []
+        matches.extend((index, lineno) for name, lineno in names for index in match_risk_name(name.split("."), rules))
+
+    hits = {}
+    for index, lineno in matches:
+        hit = hits.setdefault(index, {"count": 0, "lines": set()})
+        hit["count"] += 1
+        hit["lines"].add(lineno)
+
     found_methods = {"critical": [], "warn": [], "not_bad": []}
-    for risk, methods in RISK_METHODS.items():
-        for method in methods:
-            if re.search(r'\b' + re.escape(method) + r'\b', code):
-                found_methods[risk].append(method)
+    for index, hit in sorted(hits.items(), key=lambda item: rules["rules"][item[0]]["order"]):
+        rule = rules["rules"][index]
+        found_methods.setdefault(rule["level"], []).append({
+            "command": rule.get("command") or rule.get("name") or rule["pattern"],
+            "perms": rule.get("perms", ""),
+            "count": hit["count"],
+            "lines": sorted(hit["lines"]),
+        })
     return found_methods
 
 
+async def scan_code(code, code_hash=None):
+    load_risk_rules()
+    code_hash = code_hash or hashlib.sha256(code.encode("utf-8")).hexdigest()
+    if code_hash not in risk_cache:
+        global risk_process_pool
+        loop = asyncio.get_running_loop()
+        if len(code) >= RISK_SCAN_PROCESS_SIZE:
+            if risk_process_pool is None:
+                risk_process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=1)
+            executor = risk_process_pool
+        else:
+            executor = None
+        risk_cache[code_hash] = await loop.run_in_executor(executor, check_code_for_risk_methods, code)
+    return risk_cache[code_hash]
+
+
+def format_risk_report(found_methods):
+    report = ""
+    for risk_level, methods in found_methods.items():
+        if methods:
+            report += f"<emoji id=5470049770997292425>🌡</emoji> {risk_level.capitalize()}:\n"
+            for method in methods:
+                lines = ", ".join(str(lineno) for lineno in method["lines"])
+                report += f"- {method['command']} ({method['perms']}) - {method['count']}x, line {lines}\n"
+    return report
+
+
+async def scan_source(code, code_hash=None):
+    return format_risk_report(await scan_code(code, code_hash))
+
+
+async def scan_module_file(file_name):
+    async with aiofiles.open(file_name, 'r', encoding='utf-8') as file:
+        return await scan_source(await file.read())
+
+
+def build_help_text(app, yuki_prefix):
+    entries = sorted(accounts[app]["registry"].values(), key=lambda entry: entry["name"])
+    modules = [entry for entry in entries if entry["status"] in ("loaded", "lazy", "isolated")]
+    damaged_modules = [entry for entry in entries if entry["status"] == "damaged"]
+
+    help_text = "**<emoji id=5431895003821513760>❄️</emoji> Yuki Userbot Commands <emoji id=5431895003821513760>❄️</emoji>**\n\n"
+    help_text += f"**Modules loaded: {len(modules)}**\n"
+    for entry in modules:
+        help_text += f"<emoji id=5431736674147114227>🗂</emoji> `{entry['name']}` [{entry['cinfo']}]\n"
+
+    if damaged_modules:
+        help_text += "\n**Damaged modules:**\n"
+        for entry in damaged_modules:
+            help_text += f"<emoji id=5467928559664242360>❗️</emoji> **{entry['name']}**\n"
+            help_text += f"Error: {entry['error']}\n"
+            if entry["name"] in dependency_tasks:
+                help_text += "<emoji id=5451646226975955576>⌛️</emoji> Installing dependencies, it will be retried automatically\n"
+            help_text += "\n"
+
+    help_text += "\n**Standard commands:**\n"
+    help_text += f"<emoji id=5334544901428229844>ℹ️</emoji> {yuki_prefix}info - Bot information\n"
+    help_text += f"<emoji id=5451646226975955576>⌛️</emoji> {yuki_prefix}ping - Show bot ping\n"
+    help_text += f"<emoji id=5451959871257713464>💤</emoji> {yuki_prefix}off - Turn off the bot\n"
+    help_text += f"<emoji id=5364105043907716258>🆙</emoji> {yuki_prefix}restart - Restart the bot\n"
+    help_text += f"<emoji id=5361979468887893611>🆕</emoji> {yuki_prefix}update - Update bot, wtf it's now version? `{yuki_prefix}update all` or module names - Update modules, `{yuki_prefix}update rollback` - Previous version\n"
+    help_text += f"<emoji id=5433811242135331842>📥</emoji> {yuki_prefix}dm - `{yuki_prefix}dm` link or names - Download modules, or reply to a list of them\n"
+    help_text += f"<emoji id=5469654973308476699>💣</emoji> {yuki_prefix}delm - `{yuki_prefix}delm` module name - Delete module\n"
+    help_text += f"<emoji id=5469913852462242978>🧨</emoji> {yuki_prefix}addprefix - `{yuki_prefix}addprefix` prefix E.g: ?,! - Set a prefix\n"
+    help_text += f"<emoji id=5433614747381538714>📤</emoji> {yuki_prefix}unm - `{yuki_prefix}unm` module name - Send module file in chat\n"
+    help_text += f"<emoji id=5431721976769027887>📂</emoji> {yuki_prefix}lm - Reply `{yuki_prefix}lm` to the file. Installing a module from a file.\n"
+    help_text += f"<emoji id=5427009714745517609>✅</emoji> {yuki_prefix}check - Reply `{yuki_prefix}check` to the file check the file for bad practices\n"
+    help_text += f"<emoji id=5443132326189996902>🧑‍💻</emoji> {yuki_prefix}sh - `{yuki_prefix}sh true` - Run a command in terminal. `{yuki_prefix}sh -t 60 cmd` sets a timeout.\n"
+    help_text += f"<emoji id=5469654973308476699>💣</emoji> {yuki_prefix}kill - `{yuki_prefix}kill` job ID - Kill a running terminal job\n"
+    help_text += f"<emoji id=5451646226975955576>⌛️</emoji> {yuki_prefix}jobs - Show running terminal jobs\n"
+    help_text += f"<emoji id=5334544901428229844>ℹ️</emoji> {yuki_prefix}stats - Command latency and startup stats, `{yuki_prefix}stats export` - Write Prometheus metrics\n"
+    help_text += f"<emoji id=5188217332748527444>🔍</emoji> {yuki_prefix}logs - Recent logs. `{yuki_prefix}logs error module=name 50 text` - Filter by level, field, count or text\n"
+    help_text += f"<emoji id=5451646226975955576>⌛️</emoji> {yuki_prefix}watchdog - Show handlers blocking the bot, `on`/`off`, `quarantine` module name\n"
+    help_text += f"<emoji id=5469913852462242978>🧨</emoji> {yuki_prefix}isolate - `{yuki_prefix}isolate` module name [off] - Run a module in its own process\n"
+    help_text += f"<emoji id=5373330964372004748>📺</emoji> {yuki_prefix}backup - Backup your Yuki. `{yuki_prefix}backup full` - Backup all modules, not only changed ones."
+
+    return help_text
+
+
 async def help_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("help", prefixes=yuki_prefix))
+    @app.on_command("help")
     async def _help_command(_, message):
         try:
-            modules, damaged_modules = await load_modules()
-            
-            modules.sort(key=lambda mod: mod.__name__.split('.')[-1])
-            
-            help_text = "**<emoji id=5431895003821513760>❄️</emoji> Yuki Userbot Commands <emoji id=5431895003821513760>❄️</emoji>**\n\n"
-            help_text += f"**Modules loaded: {len(modules)}**\n"
-            for module in modules:
-                module_name = module.__name__.split('.')[-1]
-                help_text += f"<emoji id=5431736674147114227>🗂</emoji> `{module_name}` [{module.cinfo}]\n"
-
-            if damaged_modules:
-                help_text += "\n**Damaged modules:**\n"
-                for module_name, error in damaged_modules:
-                    help_text += f"<emoji id=5467928559664242360>❗️</emoji> **{module_name}**\n"
-                    help_text += f"Error: {error}\n\n"
-
-            help_text += "\n**Standard commands:**\n"
-            help_text += f"<emoji id=5334544901428229844>ℹ️</emoji> {yuki_prefix}info - Bot information\n"
-            help_text += f"<emoji id=5451646226975955576>⌛️</emoji> {yuki_prefix}ping - Show bot ping\n"
-            help_text += f"<emoji id=5451959871257713464>💤</emoji> {yuki_prefix}off - Turn off the bot\n"
-            help_text += f"<emoji id=5364105043907716258>🆙</emoji> {yuki_prefix}restart - Restart the bot\n"
-            help_text += f"<emoji id=5361979468887893611>🆕</emoji> {yuki_prefix}update - Update bot, wtf it's now version?\n"
-            help_text += f"<emoji id=5433811242135331842>📥</emoji> {yuki_prefix}dm - `{yuki_prefix}dm` link - Download module from link\n"
-            help_text += f"<emoji id=5469654973308476699>💣</emoji> {yuki_prefix}delm - `{yuki_prefix}delm` module name - Delete module\n"
-            help_text += f"<emoji id=5469913852462242978>🧨</emoji> {yuki_prefix}addprefix - `{yuki_prefix}addprefix` prefix E.g: ?,! - Set a prefix\n"
-            help_text += f"<emoji id=5433614747381538714>📤</emoji> {yuki_prefix}unm - `{yuki_prefix}unm` module name - Send module file in chat\n"
-            help_text += f"<emoji id=5431721976769027887>📂</emoji> {yuki_prefix}lm - Reply `{yuki_prefix}lm` to the file. Installing a module from a file.\n"
-            help_text += f"<emoji id=5427009714745517609>✅</emoji> {yuki_prefix}check - Reply `{yuki_prefix}check` to the file check the file for bad practices\n"
-            help_text += f"<emoji id=5443132326189996902>🧑‍💻</emoji> {yuki_prefix}sh - `{yuki_prefix}sh true` - Run a command in terminal.\n"
-            help_text += f"<emoji id=5373330964372004748>📺</emoji> {yuki_prefix}backup - Backup your Yuki."
+            help_cache = accounts[app]["help_cache"]
+            help_text = help_cache.get(yuki_prefix)
+            if help_text is None:
+                help_text = help_cache[yuki_prefix] = build_help_text(app, yuki_prefix)
 
             await message.edit(help_text)
         except Exception as e:
+            logger.exception("An error occurred while executing the help command")
             await message.reply_text(f"An error occurred while executing the help command: {str(e)}")
 
 
 
+IP_URL = "https://api.ipify.org?format=json"
+COUNTRY_URL = "https://ipinfo.io/{ip}/json"
+IP_CACHE_TTL = 3600
+SYSTEM_INFO_TTL = 10
+INFO_TIMEOUT = 5
+
+info_cache = {"ip": None, "ip_time": 0, "system": None, "system_time": 0, "refresh": None}
+
+
 def get_system_info():
+    if info_cache["system"] and time.time() - info_cache["system_time"] < SYSTEM_INFO_TTL:
+        return info_cache["system"]
+
     ram = psutil.virtual_memory()
     ram_total = ram.total / (1024 ** 3)
     ram_used = ram.used / (1024 ** 3)
@@ -143,27 +1800,43 @@ def get_system_info():
     release = platform.release()
     version = platform.version()
 
-    return ram_total, ram_used, ram_percent, system, release, version
+    info_cache["system"] = ram_total, ram_used, ram_percent, system, release, version
+    info_cache["system_time"] = time.time()
+    return info_cache["system"]
 
 
-def get_ip_and_country():
+async def fetch_ip_and_country():
     try:
-        ip_response = requests.get('https://api.ipify.org?format=json')
-        ip = ip_response.json().get('ip')
-        
+        ip = (await http_get_json(IP_URL, timeout=INFO_TIMEOUT)).get('ip')
+
+        country = None
         if ip:
-            country_response = requests.get(f'https://ipinfo.io/{ip}/json')
-            country = country_response.json().get('country')
-            return ip, country
-        else:
-            return None, None
-    except requests.RequestException as e:
-        print(f"Ошибка получения информации: {e}")
-        return None, None
+            country = (await http_get_json(COUNTRY_URL.format(ip=ip), use_etag=True, timeout=INFO_TIMEOUT)).get('country')
+        info_cache["ip"] = ip, country
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logger.warning(f"Failed to get ip information: {str(e)}")
+        if info_cache["ip"] is None:
+            info_cache["ip"] = None, None
+    info_cache["ip_time"] = time.time()
+    return info_cache["ip"]
+
+
+def refresh_ip_and_country():
+    if info_cache["refresh"] is None or info_cache["refresh"].done():
+        info_cache["refresh"] = asyncio.ensure_future(fetch_ip_and_country())
+    return info_cache["refresh"]
+
+
+async def get_ip_and_country():
+    if info_cache["ip"] is None:
+        return await refresh_ip_and_country()
+    if time.time() - info_cache["ip_time"] >= IP_CACHE_TTL:
+        refresh_ip_and_country()
+    return info_cache["ip"]
 
 
 async def info_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("info", prefixes=yuki_prefix))
+    @app.on_command("info")
     async def _info_command(_, message):
         try:
             current_time = time.time()
@@ -176,7 +1849,12 @@ async def info_command(app, yuki_prefix):
             ping_time = round((ping_end_time - ping_start_time) * 1000, 1)
             
             ram_total, ram_used, ram_percent, system, release, version = get_system_info()
-            ip, country = get_ip_and_country()
+            startup_text = ""
+            if "online" in startup_stats:
+                startup_text = f"**Startup:** {startup_stats['online']:.2f}s (modules {startup_stats['modules']:.2f}s)\n      "
+            if "restart" in startup_stats:
+                startup_text += f"**Restart:** {startup_stats['restart']:.2f}s ({last_restart['mode']})\n      "
+            ip, country = await get_ip_and_country()
             country_text = f"**Country:** {country}" if ip and country else ""
             
             caption_text = (f"**<emoji id=5431895003821513760>❄️</emoji> 雪 Yuki**\n"
@@ -186,7 +1864,7 @@ async def info_command(app, yuki_prefix):
                             f"      **RAM:** {ram_used:.2f} GB / {ram_total:.2f} GB ({ram_percent}%)\n"
                             f"      **OS:** {system} {release}\n"
                             f"      **Ping:** {ping_time}ms\n"
-                            f"      {country_text}")
+                            f"      {startup_text}{country_text}")
             
             gif_url = "https://tinypic.host/images/2024/07/29/ezgif-6-baeda9490a.gif"
             await app.send_document(
@@ -194,12 +1872,13 @@ async def info_command(app, yuki_prefix):
                 document=gif_url,
                 caption=caption_text)
         except Exception as e:
+            logger.exception("An error occurred while executing the info command")
             await message.reply_text(f"An error occurred while executing the info command: {str(e)}")
 
 
 
 async def ping_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("ping", prefixes=yuki_prefix))
+    @app.on_command("ping")
     async def _ping_command(_, message):
         try:
             ping_start_time = time.time()
@@ -210,162 +1889,318 @@ async def ping_command(app, yuki_prefix):
             uptime = str(timedelta(seconds=uptime_seconds))
             await msg.edit(f"**<emoji id=5188666899860298925>🌒</emoji> Your ping: {ping_time} ms**\n**<emoji id=5451646226975955576>⌛️</emoji> Uptime: {uptime}**")
         except Exception as e:
+            logger.exception("An error occurred while executing the ping command")
             await message.reply_text(f"An error occurred while executing the ping command: {str(e)}")
 
 
-def check_code_for_risk_methods(code):
-    found_methods = {"critical": [], "warn": [], "not_bad": []}
-    for risk_level, methods in RISK_METHODS.items():
-        for method in methods:
-            if method["command"] in code:
-                found_methods[risk_level].append(method)
-    return found_methods
-
 async def check_file(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("check", prefixes=yuki_prefix))
+    @app.on_command("check")
     async def check_dangerous_methods(client: Client, message):
         try:
-            file_path = ""
-            if message.reply_to_message and message.reply_to_message.document:
-                if message.reply_to_message.document.mime_type == "text/x-python":
-                    filename = message.reply_to_message.document.file_name
-                    file_path = os.path.join(os.getcwd(), filename)
-                    await client.download_media(message.reply_to_message.document.file_id, file_path)
-                else:
+            reply = message.reply_to_message
+            file = reply if reply and reply.document else message if message.document else None
+            if file:
+                if file.document.mime_type != "text/x-python":
                     await message.edit("<emoji id=5465665476971471368>❌</emoji> Please ensure this is a Python file.")
                     return
-            elif message.text:
+                chunks = telegram_chunks(client, file, MODULE_MAX_SIZE)
+            elif message.text and len(message.text.split(maxsplit=1)) > 1:
                 url = message.text.split(maxsplit=1)[1].strip()
-                response = requests.get(url)
-                if response.status_code == 200:
-                    filename = url.split('/')[-1]
-                    file_path = os.path.join(os.getcwd(), filename)
-                    with open(file_path, 'wb') as file:
-                        file.write(response.content)
-                else:
-                    await message.edit("<emoji id=5465665476971471368>❌</emoji> Failed to retrieve the file from the URL.")
-                    return
-            elif message.document:
-                if message.document.mime_type == "text/x-python":
-                    filename = message.document.file_name
-                    file_path = os.path.join(os.getcwd(), filename)
-                    await client.download_media(message.document.file_id, file_path)
-                else:
-                    await message.edit("<emoji id=5465665476971471368>❌</emoji> Please send a Python file.")
-                    return
+                chunks = http_chunks(url, MODULE_MAX_SIZE)
+            else:
+                await message.edit("<emoji id=5465665476971471368>❌</emoji> Reply to a Python file or provide a link to it.")
+                return
 
-            if file_path:
-                await message.edit("<emoji id=5188666899860298925>🌒</emoji> Checking the file...")
-                await asyncio.sleep(1.5)
-
-                with open(file_path, 'r', encoding='utf-8') as file:
-                    content = file.read()
-
-                found_methods = check_code_for_risk_methods(content)
-                response_text = ""
-                for risk_level, methods in found_methods.items():
-                    if methods:
-                        response_text += f"<emoji id=5470049770997292425>🌡</emoji> {risk_level.capitalize()}:\n"
-                        for method in methods:
-                            response_text += f"- {method['command']} ({method['perms']})\n"
-                if response_text:
-                    await message.edit(response_text)
-                else:
-                    await message.edit("<emoji id=5427009714745517609>✅</emoji> No dangerous methods found in the file.")
+            await message.edit("<emoji id=5188666899860298925>🌒</emoji> Checking the file...")
+            scanner = SourceScanner()
+            try:
+                await stream_download(chunks, None, MODULE_MAX_SIZE, scanner)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                await message.edit(f"<emoji id=5465665476971471368>❌</emoji> Failed to retrieve the file: {str(e)}")
+                return
+
+            code, code_hash = scanner.finish()
+            response_text = await scan_source(code, code_hash)
+            if response_text:
+                await message.edit(response_text)
             else:
-                await message.edit("<emoji id=5465665476971471368>❌</emoji> Error occurred during file processing.")
+                await message.edit("<emoji id=5427009714745517609>✅</emoji> No dangerous methods found in the file.")
 
         except Exception as e:
+            logger.exception("An error occurred while executing the check command")
             await message.edit(f"<emoji id=5465665476971471368>❌</emoji> Error occurred: {str(e)}")
 
+UPDATE_COMMITS_URL = "https://api.github.com/repos/YukiDevelopers/yuuki/commits?path=yuki.py"
+UPDATE_CONTENTS_URL = "https://api.github.com/repos/YukiDevelopers/yuuki/contents/yuki.py?ref={sha}"
+UPDATE_CHECK_INTERVAL = 6 * 3600
+UPDATE_CONCURRENCY = 5
+UPDATE_IMPORT_TEST = (
+    "import importlib.machinery, importlib.util, sys; "
+    "loader = importlib.machinery.SourceFileLoader('yuki_staged', sys.argv[1]); "
+    "loader.exec_module(importlib.util.module_from_spec(importlib.util.spec_from_loader('yuki_staged', loader)))"
+)
+
+bot_file = os.path.abspath(__file__)
+commit_file = "bot.commit"
+update_state = {"latest": None, "checked": 0}
+
+
+def git_blob_sha(content):
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def read_local_commit():
+    if os.path.exists(commit_file):
+        with open(commit_file, "r") as file:
+            return file.read().strip()
+    return None
+
+
+async def check_for_update():
+    commits = await http_get_json(UPDATE_COMMITS_URL, use_etag=True)
+    update_state["latest"] = commits[0]["sha"] if commits else None
+    update_state["checked"] = time.time()
+    return update_state["latest"]
+
+
+async def check_for_updates_periodically():
+    while True:
+        try:
+            await check_for_update()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(f"Failed to check for updates: {str(e)}")
+        await asyncio.sleep(UPDATE_CHECK_INTERVAL)
+
+
+async def stage_bot_update(commit_hash):
+    file_info = await http_get_json(UPDATE_CONTENTS_URL.format(sha=commit_hash))
+    content = await http_get_bytes(file_info["download_url"])
+    if git_blob_sha(content) != file_info["sha"]:
+        raise ValueError("downloaded file does not match the repository hash")
+
+    staged_file = f"{bot_file}.new"
+    await write_file_atomic(staged_file, content)
+    await asyncio.to_thread(compile, content, bot_file, "exec")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-c", UPDATE_IMPORT_TEST, staged_file,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE)
+    _, stderr = await asyncio.wait_for(process.communicate(), timeout=120)
+    if process.returncode:
+        os.remove(staged_file)
+        raise ImportError(stderr.decode("utf-8", "replace")[-1000:])
+    return staged_file
+
+
+def swap_bot_file(staged_file):
+    shutil.copy2(bot_file, f"{bot_file}.bak")
+    os.replace(staged_file, bot_file)
+
+
+async def update_single_module(app, module_name, semaphore):
+    source = module_metadata.get(module_name, {}).get("source")
+    if not source:
+        raise ValueError("no download source recorded")
+
+    async with semaphore:
+        status, content = await http_get(source, use_etag=True)
+    if status >= 400:
+        raise aiohttp.ClientError(f"HTTP {status}")
+    if hashlib.sha256(content).hexdigest() == module_metadata[module_name]["hash"]:
+        return False
+
+    module_file = f"{module_name}.py"
+    await asyncio.to_thread(compile, content, module_file, "exec")
+    async with aiofiles.open(module_file, 'rb') as file:
+        previous_content = await file.read()
+    await write_file_atomic(module_file, content)
+    users = [account_app for account_app, account in accounts.items() if module_name in account["registry"]] or [app]
+    try:
+        for index, account_app in enumerate(users):
+            await import_single_module(account_app, module_name, reload=index == 0)
+    except Exception:
+        await write_file_atomic(module_file, previous_content)
+        for index, account_app in enumerate(users):
+            await import_single_module(account_app, module_name, reload=index == 0)
+        raise
+    await set_module_metadata(module_name)
+    return True
+
+
+async def update_modules(app, module_names):
+    semaphore = asyncio.Semaphore(UPDATE_CONCURRENCY)
+    results = await asyncio.gather(
+        *(update_single_module(app, module_name, semaphore) for module_name in module_names), return_exceptions=True)
+    updated = [module_name for module_name, result in zip(module_names, results) if result is True]
+    failed = [(module_name, str(result)) for module_name, result in zip(module_names, results) if isinstance(result, Exception)]
+    return updated, failed
+
+
 async def update_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("update", prefixes=yuki_prefix))
+    @app.on_command("update")
     async def _update_command(_, message):
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get("https://api.github.com/repos/YukiDevelopers/yuuki/commits?path=yuki.py") as response:
-                    response.raise_for_status()
-                    commits = await response.json()
-                    if not commits:
-                        await message.edit("<emoji id=5465665476971471368>❌</emoji> Bot not found in the repository.")
-                        return
-                    last_commit_hash = commits[0]["sha"]
-
-            local_commit_hash_file = "bot.commit"
-            if os.path.exists(local_commit_hash_file):
-                with open(local_commit_hash_file, "r") as file:
-                    local_commit_hash = file.read().strip()  
-                if local_commit_hash == last_commit_hash:
-                    await message.edit(f"<emoji id=5467928559664242360>❗️</emoji> Bot is already up to date. Version: {local_commit_hash[:7]}")
+            target = message.command[1] if len(message.command) > 1 else ""
+            if target == "rollback":
+                if not os.path.exists(f"{bot_file}.bak"):
+                    await message.edit("<emoji id=5467928559664242360>❗️</emoji> No previous version to roll back to.")
                     return
+                os.replace(f"{bot_file}.bak", bot_file)
+                if os.path.exists(commit_file):
+                    os.remove(commit_file)
+                message = await message.edit("<emoji id=5427009714745517609>✅</emoji> Previous version restored, restarting...")
+                await restart_bot(app, message, reload_code=True)
+                return
+
+            if target:
+                module_names = [name for name in module_metadata if name in accounts[app]["registry"]] if target == "all" else message.command[1:]
+                await message.edit(f"<emoji id=5188666899860298925>🌒</emoji> Checking {len(module_names)} module(s) for updates...")
+                updated, failed = await update_modules(app, module_names)
+                result_text = f"<emoji id=5427009714745517609>✅</emoji> Updated {len(updated)} of {len(module_names)} module(s)."
+                if updated:
+                    result_text += f"\n{', '.join(f'`{module_name}`' for module_name in updated)}"
+                for module_name, error in failed:
+                    result_text += f"\n<emoji id=5465665476971471368>❌</emoji> `{module_name}`: {error}"
+                await message.edit(result_text)
+                return
+
+            local_commit_hash = read_local_commit()
+            last_commit_hash = update_state["latest"]
+            if last_commit_hash is None or time.time() - update_state["checked"] >= UPDATE_CHECK_INTERVAL \
+                    or last_commit_hash != local_commit_hash:
+                last_commit_hash = await check_for_update()
+            if not last_commit_hash:
+                await message.edit("<emoji id=5465665476971471368>❌</emoji> Bot not found in the repository.")
+                return
+            if local_commit_hash == last_commit_hash:
+                await message.edit(f"<emoji id=5467928559664242360>❗️</emoji> Bot is already up to date. Version: {local_commit_hash[:7]}")
+                return
 
+            await message.edit(f"<emoji id=5188666899860298925>🌒</emoji> Downloading and verifying version {last_commit_hash[:7]}...")
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get("https://raw.githubusercontent.com/YukiDevelopers/yuuki/main/yuki.py") as response:
-                        response.raise_for_status()
-                        file_name = "yuki.py"
-
-                        async with aiofiles.open(file_name, 'wb') as file:
-                            await file.write(await response.read())
-
-                        with open(local_commit_hash_file, "w") as file:
-                            file.write(last_commit_hash)
-
-                        await message.delete()
-                        await message.reply_text(
-                            f"<emoji id=5427009714745517609>✅</emoji> File `{file_name}` successfully downloaded and saved.\n\nVersion: {last_commit_hash[:7]}")
-                        os.execv(sys.executable, [sys.executable] + sys.argv)
-            except aiohttp.ClientError as e:
-                await message.reply_text(f"Error downloading file: {str(e)}")
+                staged_file = await stage_bot_update(last_commit_hash)
+            except (aiohttp.ClientError, ValueError, SyntaxError, ImportError) as e:
+                await message.edit(f"<emoji id=5465665476971471368>❌</emoji> Update rejected, the current version is kept:\n```\n{str(e)}\n```")
+                return
+
+            swap_bot_file(staged_file)
+            with open(commit_file, "w") as file:
+                file.write(last_commit_hash)
+
+            await message.delete()
+            reply = await message.reply_text(
+                f"<emoji id=5427009714745517609>✅</emoji> Update verified and installed. Version: {last_commit_hash[:7]}\n\n"
+                f"Use `{yuki_prefix}update rollback` to return to the previous version.")
+            await restart_bot(app, reply, reload_code=True)
         except Exception as e:
-            await message.reply_text(f"An error occurred while executing the dm command: {str(e)}")
+            logger.exception("An error occurred while executing the update command")
+            await message.reply_text(f"An error occurred while executing the update command: {str(e)}")
+
+
+DM_CONCURRENCY = 5
+MODULES_REPO_URL = "https://raw.githubusercontent.com/YukiDevelopers/Yuki_Modules/main/{name}.py"
+
+
+async def write_file_atomic(file_name, content):
+    temp_file = f"{file_name}.tmp"
+    async with aiofiles.open(temp_file, 'wb') as file:
+        await file.write(content)
+    os.replace(temp_file, file_name)
+
+
+def parse_module_manifest(text):
+    text = text.strip()
+    if text.startswith("["):
+        return [str(item) for item in json.loads(text)]
+    return [line.split("#")[0].strip() for line in text.splitlines() if line.split("#")[0].strip()]
+
+
+async def fetch_module(source, semaphore):
+    url = source if source.startswith("http") else MODULES_REPO_URL.format(name=source)
+    module_name = module_file_name(url.split("#", 1)[0].split("?", 1)[0])
+    async with semaphore:
+        status, content = await http_get(url)
+    if status == 404:
+        raise aiohttp.ClientError("not found in the repository")
+    if status >= 400:
+        raise aiohttp.ClientError(f"HTTP {status}")
+    return module_name, url, content
+
+
+async def install_modules(app, sources):
+    semaphore = asyncio.Semaphore(DM_CONCURRENCY)
+    results = await asyncio.gather(*(fetch_module(source, semaphore) for source in sources), return_exceptions=True)
+
+    installed, failed = [], []
+    modules_file = accounts[app]["modules_file"]
+    async with update_json(modules_file) as modules_list:
+        for source, result in zip(sources, results):
+            if isinstance(result, Exception):
+                failed.append((source, str(result)))
+                continue
+            module_name, url, content = result
+            if module_name in modules_list:
+                failed.append((module_name, f"already exists in `{modules_file}`"))
+                continue
+            await write_file_atomic(f"{module_name}.py", content)
+            modules_list.append(module_name)
+            installed.append(module_name)
+            await set_module_metadata(module_name, url)
+
+    reports = dict(zip(installed, await asyncio.gather(*(scan_module_file(f"{module_name}.py") for module_name in installed))))
+
+    damaged = []
+    for module_name in installed:
+        try:
+            await import_single_module(app, module_name)
+        except Exception as e:
+            damaged.append((module_name, str(e)))
+    return installed, damaged, failed, reports
+
 
 async def dm_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("dm", prefixes=yuki_prefix))
+    @app.on_command("dm")
     async def _dm_command(_, message):
         try:
-            if len(message.command) < 2:
+            sources = message.command[1:]
+            reply = message.reply_to_message
+            if not sources and reply and reply.document:
+                manifest = await reply.download(in_memory=True)
+                sources = parse_module_manifest(bytes(manifest.getbuffer()).decode("utf-8"))
+
+            if not sources:
                 await message.edit("<emoji id=5467928559664242360>❗️</emoji> Please provide a link to the file or module name.")
                 return
 
-            url = message.command[1]
-            if not url.startswith("http"):
-                url = f"https://raw.githubusercontent.com/YukiDevelopers/Yuki_Modules/main/{url}.py"
+            await message.edit(f"<emoji id=5431895003821513760>❄️</emoji> Downloading {len(sources)} module(s)...")
+            installed, damaged, failed, reports = await install_modules(app, list(dict.fromkeys(sources)))
+            damaged_names = [module_name for module_name, _ in damaged]
+
+            result_text = ""
+            active = [module_name for module_name in installed if module_name not in damaged_names]
+            if active:
+                result_text += f"<emoji id=5427009714745517609>✅</emoji> Installed: {', '.join(f'`{module_name}`' for module_name in active)}\n"
+            for module_name, error in damaged:
+                result_text += f"<emoji id=5467928559664242360>❗️</emoji> `{module_name}` saved, but failed to load: {error}\n"
+                if module_name in dependency_tasks:
+                    result_text += "<emoji id=5451646226975955576>⌛️</emoji> Installing its dependencies in the background, it will be loaded automatically.\n"
+                    asyncio.create_task(report_dependencies(app, message, module_name, dependency_tasks[module_name]))
+            for source, error in failed:
+                result_text += f"<emoji id=5465665476971471368>❌</emoji> `{source}`: {error}\n"
+            for module_name, report in reports.items():
+                if report:
+                    result_text += f"\n**Risk check `{module_name}`:**\n{report}"
 
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url) as response:
-                        if response.status == 404:
-                            await message.edit(f"<emoji id=5465665476971471368>❌</emoji> Module `{url}` not found in the repository.")
-                            return
-                        response.raise_for_status()
-                        file_name = os.path.basename(url)
-                        module_name = file_name[:-3]
-
-                        modules_list = await read_json(modules_file)
-                        if module_name in modules_list:
-                            await message.edit(f"<emoji id=5467928559664242360>❗️</emoji> Module `{module_name}` already exists in `{modules_file}`.")
-                            return
-
-                        async with aiofiles.open(file_name, 'wb') as file:
-                            await file.write(await response.read())
-
-                        modules_list.append(module_name)
-                        await write_json(modules_file, modules_list)
-
-                        await message.delete()
-                        await message.reply_text(
-                            f"<emoji id=5427009714745517609>✅</emoji> File `{file_name}` successfully downloaded and saved.\n\nLink: `{url}`")
-                        os.execv(sys.executable, [sys.executable] + sys.argv)
-            except aiohttp.ClientError as e:
-                await message.reply_text(f"Error downloading file: {str(e)}")
+            await message.delete()
+            await message.reply_text(result_text)
         except Exception as e:
+            logger.exception("An error occurred while executing the dm command")
             await message.reply_text(f"An error occurred while executing the dm command: {str(e)}")
 
 
 async def load_module(app: Client, yuki_prefix):
-    @app.on_message(filters.me & filters.command("lm", prefixes=yuki_prefix))
-    async def load_cmd(_, message):
+    @app.on_command("lm")
+    async def load_cmd(client, message):
         reply = message.reply_to_message
         file = message if message.document else reply if reply and reply.document else None
 
@@ -377,25 +2212,50 @@ async def load_module(app: Client, yuki_prefix):
             await message.edit("<emoji id=5465665476971471368>❌</emoji> Only .py files are supported!")
             return
 
-        filename = file.document.file_name
-        module_name = filename.split(".py")[0]
+        try:
+            module_name = module_file_name(file.document.file_name)
+        except ValueError as e:
+            await message.edit(f"<emoji id=5465665476971471368>❌</emoji> {str(e)}")
+            return
 
         await message.edit(f"<emoji id=5431895003821513760>❄️</emoji> Loading module **{module_name}**...")
 
-        file_path = os.path.join(os.getcwd(), filename)
-        await file.download(file_path)
+        scanner = SourceScanner()
+        try:
+            with tempfile.TemporaryDirectory(prefix="yuki_") as temp_dir:
+                temp_file = os.path.join(temp_dir, f"{module_name}.py")
+                await stream_download(telegram_chunks(client, file, MODULE_MAX_SIZE), temp_file, MODULE_MAX_SIZE, scanner)
+                shutil.move(temp_file, f"{module_name}.py.tmp")
+            os.replace(f"{module_name}.py.tmp", f"{module_name}.py")
+        except (OSError, ValueError) as e:
+            await message.edit(f"<emoji id=5465665476971471368>❌</emoji> Failed to download **{module_name}**: {str(e)}")
+            return
 
-        modules_list = await read_json(modules_file)
-        if module_name not in modules_list:
-            modules_list.append(module_name)
-        await write_json(modules_file, modules_list)
+        async with update_json(accounts[app]["modules_file"]) as modules_list:
+            if module_name not in modules_list:
+                modules_list.append(module_name)
+        await set_module_metadata(module_name)
 
-        await message.edit(f"<emoji id=5431895003821513760>❄️</emoji> Module **{module_name}** successfully loaded!")
-        os.execv(sys.executable, [sys.executable] + sys.argv)
+        code, code_hash = scanner.finish()
+        report = await scan_source(code, code_hash)
+        if report:
+            report = f"\n\n**Risk check:**\n{report}"
+
+        try:
+            await import_single_module(app, module_name)
+        except Exception as e:
+            if module_name in dependency_tasks:
+                await message.edit(f"<emoji id=5451646226975955576>⌛️</emoji> Module **{module_name}** saved, installing its dependencies in the background: {str(e)}{report}")
+                asyncio.create_task(report_dependencies(app, message, module_name, dependency_tasks[module_name]))
+                return
+            await message.edit(f"<emoji id=5465665476971471368>❌</emoji> Module **{module_name}** saved, but failed to load: {str(e)}{report}")
+            return
+
+        await message.edit(f"<emoji id=5431895003821513760>❄️</emoji> Module **{module_name}** successfully loaded!{report}")
 
 
 async def delm_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("delm", prefixes=yuki_prefix))
+    @app.on_command("delm")
     async def _delm_command(_, message):
         try:
             if len(message.command) < 2:
@@ -404,15 +2264,27 @@ async def delm_command(app, yuki_prefix):
 
             module_name = message.command[1]
             module_file = f"{module_name}.py"
+            modules_file = accounts[app]["modules_file"]
 
-            modules_list = await read_json(modules_file)
-            if module_name not in modules_list:
+            async with update_json(modules_file) as modules_list:
+                if module_name in modules_list:
+                    modules_list.remove(module_name)
+                    found = True
+                else:
+                    found = False
+            if not found:
                 await message.edit(f"<emoji id=5467928559664242360>❗️</emoji> Module `{module_name}` not found in `{modules_file}`.")
                 return
 
-            modules_list.remove(module_name)
-            await write_json(modules_file, modules_list)
+            await unload_single_module(app, module_name)
+            users = [account["name"] for account in accounts.values()
+                     if module_name in await read_json(account["modules_file"], default=[])]
+            if users:
+                await message.edit(
+                    f"<emoji id=5427009714745517609>✅</emoji> Module `{module_name}` successfully deleted from `{modules_file}`, file `{module_file}` kept for: {', '.join(users)}.")
+                return
 
+            await delete_module_metadata(module_name)
             if os.path.exists(module_file):
                 os.remove(module_file)
                 await message.edit(
@@ -420,34 +2292,53 @@ async def delm_command(app, yuki_prefix):
             else:
                 await message.edit(
                     f"<emoji id=5427009714745517609>✅</emoji> Module `{module_name}` successfully deleted from `{modules_file}`, but file `{module_file}` not found.")
-
-            os.execv(sys.executable, [sys.executable] + sys.argv)
         except Exception as e:
+            logger.exception("An error occurred while executing the delm command")
             await message.reply_text(f"An error occurred while executing the delm command: {str(e)}")
 
 
+async def shutdown_services():
+    await flush_state()
+    await close_http_session()
+    stop_watchdog()
+    for worker_app, module_name in list(isolated_workers):
+        await stop_isolated_module(worker_app, module_name)
+    stop_logging()
+
+
 async def off_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("off", prefixes=yuki_prefix))
+    @app.on_command("off")
     async def _off_command(_, message):
         try:
             await message.edit("**<emoji id=5451959871257713464>💤</emoji> Turning off the userbot...**")
+            if len(accounts) > 1:
+                for worker_app, module_name in list(isolated_workers):
+                    if worker_app is app:
+                        await stop_isolated_module(app, module_name)
+                accounts.pop(app)
+            else:
+                await shutdown_services()
+                if supervisor_link["writer"]:
+                    await send_to_supervisor({"type": "off"})
             await app.stop()
         except Exception as e:
+            logger.exception("An error occurred while executing the off command")
             await message.reply_text(f"An error occurred while executing the off command: {str(e)}")
 
 
 async def restart_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("restart", prefixes=yuki_prefix))
+    @app.on_command("restart")
     async def _restart_command(_, message):
         try:
-            await message.edit("**<emoji id=5361979468887893611>🆕</emoji> You Yuki will be rebooted...**")
-            os.execv(sys.executable, [sys.executable] + sys.argv)
+            message = await message.edit("**<emoji id=5361979468887893611>🆕</emoji> You Yuki will be rebooted...**")
+            await restart_bot(app, message)
         except Exception as e:
+            logger.exception("An error occurred while executing the restart command")
             await message.reply_text(f"An error occurred while executing the restart command: {str(e)}")
 
 
 async def unm_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("unm", prefixes=yuki_prefix))
+    @app.on_command("unm")
     async def _unm_command(_, message):
         try:
             if len(message.command) < 2:
@@ -465,11 +2356,12 @@ async def unm_command(app, yuki_prefix):
             await app.send_document(message.chat.id, module_file, caption=caption)
             await message.delete()
         except Exception as e:
+            logger.exception("An error occurred while executing the unm command")
             await message.reply_text(f"An error occurred while executing the unm command: {str(e)}")
 
 
 async def addprefix_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("addprefix", prefixes=yuki_prefix))
+    @app.on_command("addprefix")
     async def _addprefix_command(_, message):
         try:
             if len(message.command) < 2:
@@ -478,122 +2370,831 @@ async def addprefix_command(app, yuki_prefix):
 
             new_prefix = message.command[1]
 
-            config_data = await read_json(config_file)
-            config_data['prefix'] = new_prefix
-            await write_json(config_file, config_data)
-
-            global yuki_prefix
-            yuki_prefix = new_prefix
+            async with update_json(accounts[app]["config_file"]) as config_data:
+                config_data['prefix'] = new_prefix
 
             await message.reply_text(f"<emoji id=5427009714745517609>✅</emoji> Prefix successfully changed to `{new_prefix}`.")
             await message.delete()
-            os.execv(sys.executable, [sys.executable] + sys.argv)
+            await apply_prefix(app, new_prefix)
         except Exception as e:
+            logger.exception("An error occurred while executing the addprefix command")
             await message.reply_text(f"An error occurred while executing the addprefix command: {str(e)}")
 
 
+BACKUP_MANIFEST_FILE = "backup_manifest.json"
+BACKUP_CHUNK_SIZE = 64 * 1024
+
+
+def file_sha256(file_name):
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(BACKUP_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_backup_archive(archive_path, modules_list, previous_hashes):
+    hashes = {}
+    changed = []
+    for module_name in modules_list:
+        module_file_path = f"{module_name}.py"
+        if os.path.exists(module_file_path):
+            hashes[module_name] = file_sha256(module_file_path)
+            if previous_hashes.get(module_name) != hashes[module_name]:
+                changed.append(module_name)
+
+    manifest = json.dumps({"version": 2, "created": int(time.time()), "hashes": hashes, "files": changed}).encode("utf-8")
+    with tarfile.open(archive_path, "w:gz") as archive:
+        info = tarfile.TarInfo("manifest.json")
+        info.size = len(manifest)
+        info.mtime = int(time.time())
+        archive.addfile(info, io.BytesIO(manifest))
+        for module_name in changed:
+            archive.add(f"{module_name}.py", arcname=f"{module_name}.py")
+    return hashes, changed
+
+
+def extract_backup_archive(archive_path):
+    hashes = None
+    restored, corrupted = [], []
+    with tarfile.open(archive_path, "r|gz") as archive:
+        for member in archive:
+            if member.name == "manifest.json":
+                hashes = json.load(archive.extractfile(member))["hashes"]
+                continue
+
+            module_name = member.name[:-3]
+            if hashes is None or not member.isfile() or not member.name.endswith(".py") \
+                    or not module_name.isidentifier() or module_name not in hashes:
+                continue
+
+            digest = hashlib.sha256()
+            temp_file = f"{member.name}.tmp"
+            source = archive.extractfile(member)
+            with open(temp_file, 'wb') as module_file:
+                for chunk in iter(lambda: source.read(BACKUP_CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    module_file.write(chunk)
+
+            if digest.hexdigest() == hashes[module_name]:
+                os.replace(temp_file, member.name)
+                restored.append(module_name)
+            else:
+                os.remove(temp_file)
+                corrupted.append(module_name)
+
+    if hashes is None:
+        raise ValueError("backup manifest not found")
+    missing = [module_name for module_name, module_hash in hashes.items()
+               if module_name not in restored and module_name not in corrupted
+               and not (os.path.exists(f"{module_name}.py") and file_sha256(f"{module_name}.py") == module_hash)]
+    return list(hashes), restored, corrupted, missing
+
+
 async def backup_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("backup", prefixes=yuki_prefix))
+    @app.on_command("backup")
     async def _backup_command(_, message):
         try:
+            modules_file = accounts[app]["modules_file"]
+            backup_manifest_file = os.path.join(accounts[app]["dir"], BACKUP_MANIFEST_FILE)
             reply = message.reply_to_message
-            if reply and reply.document and reply.document.mime_type == "application/json":
-                file_path = await reply.download()
-                with open(file_path, 'r') as file:
-                    data = json.load(file)
-                
-                modules_list = await read_json(modules_file)
-                for module_name, encoded_content in data.items():
-                    module_file_path = f"{module_name}.py"
-                    with open(module_file_path, 'wb') as module_file:
-                        module_file.write(base64.b64decode(encoded_content))
-                    
-                    if module_name not in modules_list:
-                        modules_list.append(module_name)
-                
-                await write_json(modules_file, modules_list)
+            if reply and reply.document and reply.document.file_name.endswith(".tar.gz"):
+                with tempfile.TemporaryDirectory(prefix="yuki_") as temp_dir:
+                    archive_path = os.path.join(temp_dir, "backup.tar.gz")
+                    await stream_download(telegram_chunks(app, reply, BACKUP_MAX_SIZE), archive_path, BACKUP_MAX_SIZE)
+                    names, restored, corrupted, missing = await asyncio.to_thread(extract_backup_archive, archive_path)
+
+                async with update_json(modules_file) as modules_list:
+                    for module_name in names:
+                        if module_name not in modules_list and module_name not in corrupted + missing:
+                            modules_list.append(module_name)
+
+                for module_name in restored:
+                    await set_module_metadata(module_name)
+                    try:
+                        await import_single_module(app, module_name)
+                    except Exception as e:
+                        logger.error(f"An error occurred while loading module {module_name}: {str(e)}")
+
+                result_text = f"<emoji id=5427009714745517609>✅</emoji> Restored {len(restored)} module(s) from backup."
+                if corrupted:
+                    result_text += f"\n<emoji id=5465665476971471368>❌</emoji> Hash mismatch: {', '.join(corrupted)}"
+                if missing:
+                    result_text += f"\n<emoji id=5467928559664242360>❗️</emoji> Not in this backup, restore an older one first: {', '.join(missing)}"
+                await message.delete()
+                await message.reply_text(result_text)
+            elif reply and reply.document and reply.document.mime_type == "application/json":
+                with tempfile.TemporaryDirectory(prefix="yuki_") as temp_dir:
+                    file_path = os.path.join(temp_dir, "backup.json")
+                    await stream_download(telegram_chunks(app, reply, BACKUP_MAX_SIZE), file_path, BACKUP_MAX_SIZE)
+                    with open(file_path, 'r') as file:
+                        data = json.load(file)
+                for module_name in data:
+                    module_file_name(f"{module_name}.py")
+
+                async with update_json(modules_file) as modules_list:
+                    for module_name, encoded_content in data.items():
+                        await write_file_atomic(f"{module_name}.py", base64.b64decode(encoded_content))
+
+                        if module_name not in modules_list:
+                            modules_list.append(module_name)
+
+                for module_name in data:
+                    await set_module_metadata(module_name)
+                    try:
+                        await import_single_module(app, module_name)
+                    except Exception as e:
+                        logger.error(f"An error occurred while loading module {module_name}: {str(e)}")
                 await message.delete()
                 await message.reply_text("<emoji id=5427009714745517609>✅</emoji> Modules successfully restored from backup.")
             else:
+                full = len(message.command) > 1 and message.command[1] == "full"
+                previous_hashes = {}
+                if not full:
+                    previous_hashes = await read_json(backup_manifest_file, default={})
+
                 modules_list = await read_json(modules_file)
-                backup_data = {}
-                for module_name in modules_list:
-                    module_file_path = f"{module_name}.py"
-                    if os.path.exists(module_file_path):
-                        with open(module_file_path, 'rb') as module_file:
-                            encoded_content = base64.b64encode(module_file.read()).decode('utf-8')
-                            backup_data[module_name] = encoded_content
-                
-                backup_file_path = "modules_backup.json"
-                with open(backup_file_path, 'w') as backup_file:
-                    json.dump(backup_data, backup_file, indent=4)
-                    
-                await message.delete()
-                await app.send_document(
-                    message.chat.id, 
-                    backup_file_path, 
-                    caption="<emoji id=5427009714745517609>✅</emoji> Backup of modules successfully created.\n\nUse `.backup` on this message to restore the modules."
-                )
-                os.remove(backup_file_path)
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    backup_file_path = os.path.join(temp_dir, f"yuki_backup_{int(time.time())}.tar.gz")
+                    hashes, changed = await asyncio.to_thread(write_backup_archive, backup_file_path, modules_list, previous_hashes)
+
+                    await message.delete()
+                    await app.send_document(
+                        message.chat.id,
+                        backup_file_path,
+                        caption=f"<emoji id=5427009714745517609>✅</emoji> Backup of modules successfully created: {len(changed)} of {len(hashes)} module(s) changed since the last backup.\n\n"
+                                f"Use `{yuki_prefix}backup` on this message to restore the modules, `{yuki_prefix}backup full` to back up everything."
+                    )
+                await write_json(backup_manifest_file, hashes)
         except Exception as e:
+            logger.exception("An error occurred while executing the backup command")
             await message.delete()
             await message.reply_text(f"<emoji id=5465665476971471368>❌</emoji> An error occurred: {str(e)}")
 
 
+SH_TIMEOUT = 600
+SH_EDIT_INTERVAL = 2
+SH_PART_SIZE = 3500
+
+shell_jobs = {}
+shell_job_ids = itertools.count(1)
+
+
+def kill_shell_job(job):
+    try:
+        os.killpg(job["process"].pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError, AttributeError):
+        job["process"].kill()
+
+
+async def run_shell_job(job_id, command, message, timeout):
+    header = f"<emoji id=5188217332748527444>🔍</emoji> Job #{job_id}: `{command}`"
+    process = await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        start_new_session=True)
+    job = shell_jobs[job_id] = {"process": process, "command": command, "started": time.time(), "status": "running"}
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    state = {"message": message, "part": 1, "output": "", "shown": None}
+    render_lock = asyncio.Lock()
+
+    async def render(footer):
+        text = f"{header}\n"
+        if state["part"] > 1:
+            text += f"Part {state['part']}\n"
+        text += f"```\n{state['output'] or ' '}\n```\n{footer}"
+        if text != state["shown"]:
+            state["shown"] = text
+            await state["message"].edit_text(text)
+
+    async def editor():
+        while True:
+            await asyncio.sleep(SH_EDIT_INTERVAL)
+            try:
+                async with render_lock:
+                    await render(f"<emoji id=5451646226975955576>⌛️</emoji> Running for {int(time.time() - job['started'])}s")
+            except Exception as e:
+                logger.warning(f"Failed to update job #{job_id} output: {str(e)}")
+
+    editor_task = asyncio.create_task(editor())
+    try:
+        deadline = job["started"] + timeout
+        while True:
+            try:
+                chunk = await asyncio.wait_for(process.stdout.read(1024), timeout=max(deadline - time.time(), 0))
+            except asyncio.TimeoutError:
+                job["status"] = "timed out"
+                kill_shell_job(job)
+                break
+            if not chunk:
+                break
+            state["output"] += decoder.decode(chunk)
+            while len(state["output"]) > SH_PART_SIZE:
+                async with render_lock:
+                    rest = state["output"][SH_PART_SIZE:]
+                    state["output"] = state["output"][:SH_PART_SIZE]
+                    await render(f"<emoji id=5451646226975955576>⌛️</emoji> Continued in part {state['part'] + 1}")
+                    next_message = await message.reply_text(f"{header}\nPart {state['part'] + 1}")
+                    state.update(message=next_message, part=state["part"] + 1, output=rest, shown=None)
+
+        state["output"] += decoder.decode(b"", final=True)
+        return_code = await process.wait()
+        if job["status"] == "running":
+            job["status"] = f"exited with code {return_code}"
+    finally:
+        editor_task.cancel()
+        shell_jobs.pop(job_id, None)
+
+    await render(f"<emoji id=5427009714745517609>✅</emoji> Job #{job_id} {job['status']} after {int(time.time() - job['started'])}s")
+
+
 async def terminal_command(app, yuki_prefix):
-    @app.on_message(filters.me & filters.command("sh", prefixes=yuki_prefix))
+    @app.on_command("sh")
     async def _terminal_command(_, message):
         if len(message.command) > 1:
-            command = " ".join(message.command[1:])
-            try:
-                result = subprocess.run(command, shell=True, capture_output=True, text=True)
-                output = result.stdout if result.stdout else result.stderr
+            command = message.text.split(maxsplit=1)[1]
+            timeout = SH_TIMEOUT
+            if message.command[1] == "-t" and len(message.command) > 3 and message.command[2].isdigit():
+                timeout = int(message.command[2])
+                command = command.split(maxsplit=2)[2]
 
-                chunk_size = 4096
-                if len(output) > chunk_size:
-                    for i in range(0, len(output), chunk_size):
-                        await message.reply_text(f"<emoji id=5188217332748527444>🔍</emoji> Result (part {i//chunk_size + 1}):\n```\n{output[i:i+chunk_size]}\n```")
-                else:
-                    await message.edit_text(f"<emoji id=5188217332748527444>🔍</emoji> Result:\n```\n{output}\n```")
-            except Exception as e:
-                error_message = ''.join(traceback.format_exception(None, e, e.__traceback__))
-                await message.edit_text(f"<emoji id=5465665476971471368>❌</emoji> Error:\n```\n{error_message}\n```")
+            job_id = next(shell_job_ids)
+
+            async def job_runner():
+                try:
+                    await run_shell_job(job_id, command, message, timeout)
+                except Exception as e:
+                    await message.edit_text(f"<emoji id=5465665476971471368>❌</emoji> Error:\n```\n{str(e)}\n```")
+
+            asyncio.create_task(job_runner())
         else:
             await message.edit_text("<emoji id=5422858869372104873>🙅‍♂️</emoji> Please provide a command to execute")
 
+    @app.on_command("kill")
+    async def _kill_command(_, message):
+        if len(message.command) < 2 or not message.command[1].isdigit():
+            await message.edit_text("<emoji id=5467928559664242360>❗️</emoji> Please provide the job ID to kill.")
+            return
+
+        job = shell_jobs.get(int(message.command[1]))
+        if not job:
+            await message.edit_text(f"<emoji id=5467928559664242360>❗️</emoji> Job #{message.command[1]} not found.")
+            return
+
+        job["status"] = "killed"
+        kill_shell_job(job)
+        await message.edit_text(f"<emoji id=5469654973308476699>💣</emoji> Job #{message.command[1]} killed.")
+
+    @app.on_command("jobs")
+    async def _jobs_command(_, message):
+        if not shell_jobs:
+            await message.edit_text("<emoji id=5427009714745517609>✅</emoji> No running jobs.")
+            return
+
+        jobs_text = "**Running jobs:**\n"
+        for job_id, job in shell_jobs.items():
+            jobs_text += f"#{job_id} `{job['command']}` - {int(time.time() - job['started'])}s\n"
+        await message.edit_text(jobs_text)
+
 
-async def load_and_exec_modules(app):
+LOGS_DEFAULT_COUNT = 20
+
+
+def filter_log_records(arguments):
+    min_level, count, fields, words = logging.INFO, LOGS_DEFAULT_COUNT, {}, []
+    for argument in arguments:
+        key, separator, value = argument.partition("=")
+        if separator and key in LOG_FIELDS.values():
+            fields[key] = value
+        elif argument.isdigit():
+            count = int(argument)
+        elif isinstance(logging.getLevelName(argument.upper()), int):
+            min_level = logging.getLevelName(argument.upper())
+        else:
+            words.append(argument.lower())
+
+    records = []
+    for record in reversed(list(log_buffer)):
+        if logging.getLevelName(record["level"]) < min_level:
+            continue
+        if any(str(record.get(key, "")) != value for key, value in fields.items()):
+            continue
+        if any(word not in record["message"].lower() for word in words):
+            continue
+        records.append(record)
+        if len(records) >= count:
+            break
+    return records[::-1]
+
+
+def format_log_record(record):
+    line = f"{time.strftime('%H:%M:%S', time.localtime(record['time']))} {record['level'][0]} "
+    if "module" in record:
+        line += f"[{record['module']}.{record.get('command', '')}"
+        line += f" {record['chat']}] " if "chat" in record else "] "
+    line += record["message"]
+    if "duration" in record:
+        line += f" ({record['duration']}ms)"
+    if "error" in record and record["error"] not in line:
+        line += f": {record['error']}"
+    return line
+
+
+async def logs_command(app, yuki_prefix):
+    @app.on_command("logs")
+    async def _logs_command(_, message):
+        try:
+            records = filter_log_records(message.command[1:])
+            if not records:
+                await message.edit("<emoji id=5427009714745517609>✅</emoji> No matching log records.")
+                return
+
+            lines = []
+            size = 100
+            for record in reversed(records):
+                line = format_log_record(record)[:500]
+                if size + len(line) + 1 > MESSAGE_LIMIT:
+                    break
+                lines.append(line)
+                size += len(line) + 1
+            header = f"**<emoji id=5188217332748527444>🔍</emoji> Last {len(lines)} log record(s):**\n"
+            await message.edit(header + "```\n" + "\n".join(reversed(lines)) + "\n```")
+        except Exception as e:
+            logger.exception("An error occurred while executing the logs command")
+            await message.reply_text(f"An error occurred while executing the logs command: {str(e)}")
+
+
+async def stats_command(app, yuki_prefix):
+    @app.on_command("stats")
+    async def _stats_command(_, message):
+        try:
+            if len(message.command) > 1 and message.command[1] == "export":
+                await export_metrics()
+                await message.edit(f"<emoji id=5427009714745517609>✅</emoji> Metrics exported to `{METRICS_FILE}`.")
+                return
+
+            stats_text = "**<emoji id=5431895003821513760>❄️</emoji> Yuki stats**\n\n**Startup:**\n"
+            for phase, duration in startup_stats.items():
+                stats_text += f"      {phase}: {duration * 1000:.0f}ms\n"
+            stats_text += f"\n**Loop lag:** {loop_lag['last'] * 1000:.1f}ms (max {loop_lag['max'] * 1000:.1f}ms)\n"
+
+            stats_text += "\n**Handlers:**\n"
+            top_metrics = sorted(handler_metrics.items(), key=lambda item: item[1]["count"], reverse=True)[:20]
+            for (source, command), metric in top_metrics:
+                stats_text += (f"`{source}.{command}` {metric['count']} calls, {metric['errors']} errors, "
+                               f"p50 {percentile(metric['samples'], 0.5) * 1000:.0f}ms / "
+                               f"p95 {percentile(metric['samples'], 0.95) * 1000:.0f}ms / "
+                               f"p99 {percentile(metric['samples'], 0.99) * 1000:.0f}ms\n")
+            if not top_metrics:
+                stats_text += "No commands handled yet.\n"
+
+            await message.edit(stats_text)
+        except Exception as e:
+            logger.exception("An error occurred while executing the stats command")
+            await message.reply_text(f"An error occurred while executing the stats command: {str(e)}")
+
+
+async def watchdog_command(app, yuki_prefix):
+    @app.on_command("watchdog")
+    async def _watchdog_command(_, message):
+        try:
+            action = message.command[1] if len(message.command) > 1 else ""
+            if action in ("on", "off"):
+                async with update_json(accounts[app]["config_file"]) as config_data:
+                    config_data["watchdog"] = action == "on"
+                if action == "on":
+                    start_watchdog()
+                else:
+                    stop_watchdog()
+                await message.edit(f"<emoji id=5427009714745517609>✅</emoji> Watchdog turned {action}.")
+                return
+
+            if action == "quarantine":
+                if len(message.command) < 3 or message.command[2] not in accounts[app]["registry"]:
+                    await message.edit("<emoji id=5467928559664242360>❗️</emoji> Please provide a loaded module name.")
+                    return
+                await unload_single_module(app, message.command[2])
+                await message.edit(f"<emoji id=5469654973308476699>💣</emoji> Module `{message.command[2]}` unloaded until the next restart.")
+                return
+
+            enabled = bool(watchdog_state["thread"] and watchdog_state["thread"].is_alive())
+            watchdog_text = f"**<emoji id=5451646226975955576>⌛️</emoji> Watchdog:** {'on' if enabled else 'off'} (threshold {WATCHDOG_THRESHOLD}s)\n\n"
+            if not loop_stalls:
+                watchdog_text += "No event loop stalls recorded."
+            else:
+                totals = collections.Counter()
+                for stall in loop_stalls:
+                    totals[stall["source"]] += stall["duration"]
+                watchdog_text += "**Blocked time by source:**\n"
+                for source, duration in totals.most_common():
+                    watchdog_text += f"`{source}` {duration:.2f}s\n"
+                watchdog_text += "\n**Recent stalls:**\n"
+                for stall in list(loop_stalls)[-5:]:
+                    watchdog_text += f"`{stall['source']}.{stall['command']}` {stall['duration']:.2f}s\n"
+                watchdog_text += f"\n**Last stack:**\n```\n{loop_stalls[-1]['stack'][-1500:]}\n```"
+
+            await message.edit(watchdog_text)
+        except Exception as e:
+            logger.exception("An error occurred while executing the watchdog command")
+            await message.reply_text(f"An error occurred while executing the watchdog command: {str(e)}")
+
+
+async def isolate_command(app, yuki_prefix):
+    @app.on_command("isolate")
+    async def _isolate_command(_, message):
+        try:
+            if len(message.command) < 2:
+                await message.edit("<emoji id=5467928559664242360>❗️</emoji> Please provide the module name to isolate.")
+                return
+
+            module_name = message.command[1]
+            enable = not (len(message.command) > 2 and message.command[2] == "off")
+            account = accounts[app]
+            if module_name not in await read_json(account["modules_file"]):
+                await message.edit(f"<emoji id=5467928559664242360>❗️</emoji> Module `{module_name}` not found in `{account['modules_file']}`.")
+                return
+
+            isolated_modules = account["isolated_modules"]
+            if enable:
+                isolated_modules.add(module_name)
+            else:
+                isolated_modules.discard(module_name)
+            async with update_json(account["config_file"]) as config_data:
+                config_data["isolated_modules"] = sorted(isolated_modules)
+
+            await unload_single_module(app, module_name)
+            try:
+                await import_single_module(app, module_name)
+            except Exception as e:
+                await message.edit(f"<emoji id=5465665476971471368>❌</emoji> Module `{module_name}` failed to load: {str(e)}")
+                return
+            mode = "in a separate process" if enable else "in the main process"
+            await message.edit(f"<emoji id=5427009714745517609>✅</emoji> Module `{module_name}` now runs {mode}.")
+        except Exception as e:
+            logger.exception("An error occurred while executing the isolate command")
+            await message.reply_text(f"An error occurred while executing the isolate command: {str(e)}")
+
+
+async def load_and_exec_modules(app, yuki_prefix):
     try:
-        modules, _ = await load_modules()
-        for module in modules:
-            if hasattr(module, 'register_module'):
-                module.register_module(app)
+        modules_list = await read_json(accounts[app]["modules_file"])
+        for module_name in modules_list:
+            try:
+                await load_single_module(app, module_name, yuki_prefix, reload=False)
+            except Exception as e:
+                logger.error(f"An error occurred while loading module {module_name}: {str(e)}")
     except Exception as e:
         logger.error(f"An error occurred while loading modules: {str(e)}")
 
 
+CORE_COMMANDS = [
+    help_command,
+    info_command,
+    ping_command,
+    dm_command,
+    delm_command,
+    off_command,
+    restart_command,
+    unm_command,
+    addprefix_command,
+    load_module,
+    check_file,
+    update_command,
+    backup_command,
+    terminal_command,
+    stats_command,
+    logs_command,
+    watchdog_command,
+    isolate_command,
+]
+
+
+async def register_core_commands(app, yuki_prefix):
+    for register in CORE_COMMANDS:
+        accounts[app]["core_handlers"].extend(await capture_handlers(app, register, yuki_prefix, source="core"))
+
+
+async def apply_prefix(app, yuki_prefix):
+    command_dispatchers[app]["prefix"] = yuki_prefix
+    remove_handlers(app, accounts[app]["core_handlers"])
+    accounts[app]["core_handlers"].clear()
+    await register_core_commands(app, yuki_prefix)
+    for module_name in list(accounts[app]["registry"]):
+        try:
+            await load_single_module(app, module_name, yuki_prefix, reload=False)
+        except Exception as e:
+            logger.error(f"An error occurred while reloading module {module_name}: {str(e)}")
+
+
+def run_startup_phase(loop, phase, coroutine):
+    phase_start_time = time.time()
+    result = loop.run_until_complete(coroutine)
+    startup_stats[phase] = time.time() - phase_start_time
+    return result
+
+
+ACCOUNTS_DIR = "accounts"
+
+
+def find_account_dirs(argv):
+    if argv[:1] != ["--accounts"]:
+        return [None]
+    accounts_dir = argv[1] if len(argv) > 1 else ACCOUNTS_DIR
+    account_dirs = sorted(os.path.join(accounts_dir, name) for name in os.listdir(accounts_dir)
+                          if os.path.isdir(os.path.join(accounts_dir, name)))
+    if not account_dirs:
+        raise SystemExit(f"No accounts found in {accounts_dir}, create a directory for each account there")
+    return account_dirs
+
+
+async def init_accounts(account_dirs):
+    return [await init_bot(account_dir) for account_dir in account_dirs]
+
+
+async def load_accounts(started_accounts):
+    for app, yuki_prefix in started_accounts:
+        await load_and_exec_modules(app, yuki_prefix)
+
+
+async def register_accounts(started_accounts):
+    for app, yuki_prefix in started_accounts:
+        await register_core_commands(app, yuki_prefix)
+
+
+async def stop_accounts(started_accounts):
+    for app, _ in started_accounts:
+        with contextlib.suppress(ConnectionError):
+            await app.stop()
+
+
+HANDOVER_FILE = "handover.json"
+HANDOVER_TIMEOUT = 30
+SUPERVISOR_FD_ENV = "YUKI_SUPERVISOR_FD"
+SUPERVISOR_RESPAWN_DELAY = 5
+
+supervisor_link = {"reader": None, "writer": None}
+prewarmed_modules = {}
+last_restart = {}
+
+
+async def connect_supervisor():
+    fd = os.environ.pop(SUPERVISOR_FD_ENV, None)
+    if fd is None:
+        return
+    supervisor_link["reader"], supervisor_link["writer"] = await asyncio.open_unix_connection(sock=socket.socket(fileno=int(fd)))
+
+
+async def send_to_supervisor(data):
+    supervisor_link["writer"].write(json.dumps(data).encode() + b"\n")
+    await supervisor_link["writer"].drain()
+
+
+async def wait_for_supervisor(message_type):
+    if supervisor_link["reader"] is None:
+        return
+    while True:
+        line = await supervisor_link["reader"].readline()
+        if not line:
+            raise SystemExit("Supervisor exited")
+        if json.loads(line)["type"] == message_type:
+            return
+
+
+def prewarm_modules(account_dirs):
+    for account_dir in account_dirs:
+        try:
+            with open(os.path.join(account_dir or ".", config_file)) as file:
+                isolated_modules = set(json.load(file).get("isolated_modules", []))
+            with open(os.path.join(account_dir or ".", modules_file)) as file:
+                module_names = json.load(file)
+        except (OSError, ValueError):
+            continue
+
+        for module_name in module_names:
+            if module_name in isolated_modules or module_name in sys.modules or read_module_metadata(module_name).get("commands"):
+                continue
+            try:
+                prewarmed_modules[module_name] = os.path.getmtime(f"{module_name}.py")
+                importlib.import_module(module_name)
+            except Exception as e:
+                prewarmed_modules.pop(module_name, None)
+                sys.modules.pop(module_name, None)
+                logger.warning(f"Could not prewarm module {module_name}: {str(e)}")
+
+
+def drop_stale_modules():
+    for module_name, mtime in prewarmed_modules.items():
+        with contextlib.suppress(OSError):
+            if os.path.getmtime(f"{module_name}.py") == mtime:
+                continue
+        sys.modules.pop(module_name, None)
+    prewarmed_modules.clear()
+
+
+async def wait_for_activation(account_dirs):
+    global start_time
+    await connect_supervisor()
+    if supervisor_link["reader"] is None:
+        return
+    prewarm_modules(account_dirs)
+    await wait_for_supervisor("start")
+    drop_stale_modules()
+    start_time = time.time()
+
+
+def track_handled_messages(app, handled):
+    async def remember_message(_, message):
+        handled.append([message.chat.id, message.id])
+
+    Client.add_handler(app, pyrogram.handlers.MessageHandler(remember_message), -1)
+
+
+async def restart_bot(app, message, reload_code=False):
+    handover = {
+        "requested": time.time(),
+        "mode": "warm" if supervisor_link["writer"] else "cold",
+        "account": accounts[app]["name"],
+        "chat_id": message.chat.id,
+        "message_id": message.id,
+        "text": message.text.html if message.text else "",
+        "states": {},
+        "handled": [],
+    }
+    for worker_app, account in accounts.items():
+        track_handled_messages(worker_app, handover["handled"])
+        try:
+            state = await worker_app.invoke(pyrogram.raw.functions.updates.GetState())
+        except Exception as e:
+            logger.warning(f"Could not save the update state of account {account['name']}: {str(e)}")
+            continue
+        handover["states"][account["name"]] = {"pts": state.pts, "qts": state.qts, "date": state.date}
+
+    if supervisor_link["writer"] is None:
+        await shutdown_services()
+        write_json_file(HANDOVER_FILE, json.dumps(handover))
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    await flush_state()
+    await send_to_supervisor({"type": "restart", "reload": reload_code})
+    asyncio.ensure_future(hand_over(handover))
+
+
+async def hand_over(handover):
+    for app in list(accounts):
+        with contextlib.suppress(ConnectionError):
+            await app.stop()
+    write_json_file(HANDOVER_FILE, json.dumps(handover))
+    await shutdown_services()
+    await send_to_supervisor({"type": "released"})
+    os._exit(0)
+
+
+async def replay_missed_updates(app, state, handled):
+    difference = await app.invoke(pyrogram.raw.functions.updates.GetDifference(
+        pts=state["pts"], date=state["date"], qts=state["qts"]))
+    if not isinstance(difference, (pyrogram.raw.types.updates.Difference, pyrogram.raw.types.updates.DifferenceSlice)):
+        return 0
+
+    users = {user.id: user for user in difference.users}
+    chats = {chat.id: chat for chat in difference.chats}
+    replayed = 0
+    for message in difference.new_messages:
+        peer = getattr(message, "peer_id", None)
+        if peer is None or (pyrogram.utils.get_peer_id(peer), message.id) in handled:
+            continue
+        app.dispatcher.updates_queue.put_nowait(
+            (pyrogram.raw.types.UpdateNewMessage(message=message, pts=0, pts_count=0), users, chats))
+        replayed += 1
+    return replayed
+
+
+async def finish_handover(started_accounts):
+    try:
+        with open(HANDOVER_FILE) as file:
+            handover = json.load(file)
+    except (OSError, ValueError):
+        return
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(HANDOVER_FILE)
+
+    handled = {tuple(item) for item in handover["handled"]}
+    for app, _ in started_accounts:
+        account = accounts[app]
+        if account["name"] in handover["states"]:
+            try:
+                replayed = await replay_missed_updates(app, handover["states"][account["name"]], handled)
+                if replayed:
+                    logger.info(f"Replayed {replayed} message(s) received by {account['name']} during the restart")
+            except Exception as e:
+                logger.warning(f"Could not replay missed updates for {account['name']}: {str(e)}")
+
+        if account["name"] == handover["account"]:
+            restart_seconds = time.time() - handover["requested"]
+            with contextlib.suppress(Exception):
+                await app.edit_message_text(
+                    handover["chat_id"], handover["message_id"],
+                    f"{handover['text']}\n\n<emoji id=5427009714745517609>✅</emoji> Back online in {restart_seconds:.2f}s")
+            startup_stats["restart"] = time.time() - handover["requested"]
+            last_restart["mode"] = handover["mode"]
+
+
+async def spawn_bot_instance(argv):
+    parent_socket, child_socket = socket.socketpair()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, bot_file, *argv,
+        pass_fds=[child_socket.fileno()],
+        env=dict(os.environ, **{SUPERVISOR_FD_ENV: str(child_socket.fileno())}))
+    child_socket.close()
+    reader, writer = await asyncio.open_unix_connection(sock=parent_socket)
+    return {"process": process, "reader": reader, "writer": writer}
+
+
+async def send_to_instance(instance, data):
+    instance["writer"].write(json.dumps(data).encode() + b"\n")
+    await instance["writer"].drain()
+
+
+async def read_instance(instance, timeout=None):
+    line = await asyncio.wait_for(instance["reader"].readline(), timeout)
+    return json.loads(line) if line else None
+
+
+async def stop_instance(instance):
+    if instance["process"].returncode is None:
+        instance["process"].terminate()
+    await instance["process"].wait()
+    instance["writer"].close()
+
+
+async def supervise(argv):
+    active = await spawn_bot_instance(argv)
+    await send_to_instance(active, {"type": "start"})
+    standby = await spawn_bot_instance(argv)
+    try:
+        while True:
+            data = await read_instance(active)
+            if data and data["type"] == "off":
+                return
+            if data and data["type"] == "restart":
+                if data.get("reload") or standby["process"].returncode is not None:
+                    await stop_instance(standby)
+                    standby = await spawn_bot_instance(argv)
+                try:
+                    await read_instance(active, HANDOVER_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.warning("Yuki did not release the session in time, stopping it")
+            elif data is None:
+                logger.warning(f"Yuki exited with code {await active['process'].wait()}, starting the standby instance")
+                await asyncio.sleep(SUPERVISOR_RESPAWN_DELAY)
+                if standby["process"].returncode is not None:
+                    await stop_instance(standby)
+                    standby = await spawn_bot_instance(argv)
+            else:
+                continue
+
+            await stop_instance(active)
+            active, standby = standby, None
+            await send_to_instance(active, {"type": "start"})
+            standby = await spawn_bot_instance(argv)
+    finally:
+        for instance in (active, standby):
+            if instance:
+                await stop_instance(instance)
+
+
 def main():
+    with contextlib.suppress(ImportError):
+        import uvloop
+        asyncio.set_event_loop(uvloop.new_event_loop())
     loop = asyncio.get_event_loop()
-    app, yuki_prefix = loop.run_until_complete(init_bot())
-
-    loop.run_until_complete(load_and_exec_modules(app))
-    loop.run_until_complete(help_command(app, yuki_prefix))
-    loop.run_until_complete(info_command(app, yuki_prefix))
-    loop.run_until_complete(ping_command(app, yuki_prefix))
-    loop.run_until_complete(dm_command(app, yuki_prefix))
-    loop.run_until_complete(delm_command(app, yuki_prefix))
-    loop.run_until_complete(off_command(app, yuki_prefix))
-    loop.run_until_complete(restart_command(app, yuki_prefix))
-    loop.run_until_complete(unm_command(app, yuki_prefix))
-    loop.run_until_complete(addprefix_command(app, yuki_prefix))
-    loop.run_until_complete(load_module(app, yuki_prefix))
-    loop.run_until_complete(check_file(app, yuki_prefix))
-    loop.run_until_complete(update_command(app, yuki_prefix))
-    loop.run_until_complete(backup_command(app, yuki_prefix))
-    loop.run_until_complete(terminal_command(app, yuki_prefix))
-
-    app.run()
+    startup_stats["imports"] = time.time() - start_time
+    account_dirs = find_account_dirs(sys.argv[1:])
+    loop.run_until_complete(wait_for_activation(account_dirs))
+    setup_logging()
+    started_accounts = run_startup_phase(loop, "init", init_accounts(account_dirs))
+
+    run_startup_phase(loop, "modules", load_accounts(started_accounts))
+    run_startup_phase(loop, "commands", register_accounts(started_accounts))
+    refresh_ip_and_country()
+    asyncio.ensure_future(check_for_updates_periodically())
+    asyncio.ensure_future(monitor_loop_lag())
+    if METRICS_EXPORT_INTERVAL:
+        asyncio.ensure_future(export_metrics_periodically())
+
+    run_startup_phase(loop, "connect", asyncio.gather(*(app.start() for app, _ in started_accounts)))
+    startup_stats["online"] = time.time() - start_time
+    loop.run_until_complete(finish_handover(started_accounts))
+    loop.run_until_complete(idle())
+    loop.run_until_complete(shutdown_services())
+    loop.run_until_complete(stop_accounts(started_accounts))
 
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] == ["--worker"]:
+        asyncio.run(module_worker(sys.argv[2]))
+    elif sys.argv[1:2] == ["--supervise"]:
+        asyncio.run(supervise(sys.argv[2:]))
+    else:
+        main()